@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmarks of odnoklassniki_discussions hot paths.
+
+Example usage:
+
+    $ python benchmark.py parse --items 5000 --repeat 20
+    $ python benchmark.py ingest --discussions 100 --comments 50 --likes 20 --latency 0.01
+    $ python benchmark.py ingest --record cassette.json
+    $ python benchmark.py ingest --cassette cassette.json
+'''
+
+import argparse
+import gc
+import json
+import re
+import time
+
+from odnoklassniki_discussions.normalizers import discussion_normalizer
+
+# discussions.get
+DISCUSSION_RESPONSE = {
+    'discussion': {
+        'attrs': {'flags': 'c,l,s'},
+        'creation_date': '2013-10-12 14:29:26',
+        'last_activity_date': '2013-10-12 14:29:26',
+        'last_user_access_date': '2013-10-12 14:29:26',
+        'like_count': 1,
+        'liked_it': False,
+        'message': u'Topic in the {group:47241470410797}Кока-Кола{group} group',
+        'new_comments_count': 0,
+        'object_id': '62190641299501',
+        'object_type': 'GROUP_TOPIC',
+        'owner_uid': '163873406852',
+        'ref_objects': [{'id': '47241470410797', 'type': 'GROUP'}],
+        'title': u'Кока-Кола  один из спонсоров  Олимпиады в Сочи.',
+        'total_comments_count': 137,
+    },
+    'entities': {
+        'groups': [{'name': u'Кока-Кола', 'uid': '47241470410797'}],
+        'users': [{'first_name': u'Любовь', 'last_name': u'Гуревич', 'uid': '163873406852'}],
+    },
+}
+
+# mediatopic.getByIds
+MEDIATOPIC_RESPONSE = {
+    'id': '62465446084728',
+    'author_ref': 'group:53038939046008',
+    'owner_ref': 'group:53038939046008',
+    'created_ms': 1394010000000,
+    'media': [{'type': 'text', 'text': u'PHP - это действительно просто.'}],
+    'like_summary': {'count': 36, 'self': False},
+    'reshare_summary': {'count': 1, 'self': False},
+    'discussion_summary': {'comments_count': 3},
+}
+
+# stream.get
+STREAM_RESPONSE = {
+    'pattern': 'POST',
+    'message': u'{media_topic:62465446084728}Опубликовал заметку',
+    'date': '2014-03-05 12:00:00',
+    'author_ref': 'group:53038939046008',
+    'owner_ref': 'group:53038939046008',
+    'like_summary': {'count': 36, 'self': False},
+    'discussion_summary': {'comments_count': 3},
+}
+
+SHAPES = [
+    ('discussions.get', DISCUSSION_RESPONSE),
+    ('mediatopic.getByIds', MEDIATOPIC_RESPONSE),
+    ('stream.get', STREAM_RESPONSE),
+]
+
+
+def normalize_legacy(response):
+    '''
+    Chain of conditions from Discussion.parse before DiscussionResponseNormalizer, references are only splitted
+    '''
+    refs = {}
+    if 'discussion' in response:
+        response.update(response.pop('discussion'))
+
+    if 'entities' in response and 'media_topics' in response['entities'] \
+            and len(response['entities']['media_topics']) == 1:
+        response.update(response['entities'].pop('media_topics')[0])
+        if 'polls' in response['entities']:
+            response.update(response['entities'].pop('polls')[0])
+            if 'vote_summary' in response:
+                response['last_vote_date'] = response['vote_summary']['last_vote_date_ms'] / 1000
+                response['votes_count'] = response['vote_summary']['count']
+
+    if 'like_summary' in response:
+        response['likes_count'] = response['like_summary']['count']
+        response.pop('like_summary')
+    if 'reshare_summary' in response:
+        response['reshares_count'] = response['reshare_summary']['count']
+        response.pop('reshare_summary')
+    if 'discussion_summary' in response:
+        response['comments_count'] = response['discussion_summary']['comments_count']
+        response.pop('discussion_summary')
+    if 'author_ref' in response:
+        i = response.pop('author_ref').split(':')
+        response['author_id'] = i[1]
+        refs['author'] = i[0]
+    if 'owner_ref' in response:
+        i = response.pop('owner_ref').split(':')
+        response['owner_id'] = i[1]
+        refs['owner'] = i[0]
+    if 'created_ms' in response:
+        response['date'] = response.pop('created_ms') / 1000
+    if 'media' in response:
+        response['title'] = response['media'][0]['text']
+
+    if 'owner_uid' in response:
+        response['author_id'] = response.pop('owner_uid')
+    if 'like_count' in response:
+        response['likes_count'] = response.pop('like_count')
+    if 'total_comments_count' in response:
+        response['comments_count'] = response.pop('total_comments_count')
+    if 'creation_date' in response:
+        response['date'] = response.pop('creation_date')
+
+    if 'message' in response and '{media_topic' in response['message']:
+        regexp = r'{media_topic:?(\d+)?}'
+        m = re.findall(regexp, response['message'])
+        if len(m):
+            response['id'] = m[0]
+            response['message'] = re.sub(regexp, '', response['message'])
+
+    return refs
+
+
+def measure(normalize, response, items):
+    response = json.dumps(response)
+    responses = [json.loads(response) for i in xrange(items)]
+    gc.disable()
+    started = time.time()
+    for response in responses:
+        normalize(response)
+    finished = time.time()
+    gc.enable()
+    return items / (finished - started)
+
+
+def benchmark_parse(items, repeat):
+    for name, response in SHAPES:
+        legacy, normalized = json.loads(json.dumps(response)), json.loads(json.dumps(response))
+        assert normalize_legacy(legacy) == discussion_normalizer.normalize(normalized) and legacy == normalized, name
+
+        # runs are paired and ratio is median of pairs, that is less affected by noise of machine than best runs
+        legacy, current, ratios = 0, 0, []
+        for i in range(repeat):
+            pair = measure(normalize_legacy, response, items), measure(discussion_normalizer.normalize, response, items)
+            legacy, current = max(legacy, pair[0]), max(current, pair[1])
+            ratios.append(pair[1] / pair[0])
+        ratios.sort()
+        print('%-20s legacy: %10d items/sec, current: %10d items/sec, median x%.2f' % (
+            name, legacy, current, ratios[len(ratios) // 2]))
+
+
+def setup_django(**custom_settings):
+    '''
+    Configure settings of tests with in-memory database and create tables
+    '''
+    from django.conf import settings
+    import settings_test
+
+    options = dict([(k, v) for k, v in settings_test.__dict__.items() if k[0] != '_'])
+    options.update(custom_settings)
+    installed_apps = ('django.contrib.auth', 'django.contrib.contenttypes') + options.pop('INSTALLED_APPS') \
+        + ('odnoklassniki_discussions',)
+    settings.configure(DEBUG=True, USE_TZ=True, INSTALLED_APPS=installed_apps,
+                       DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+                       **options)
+
+    from django.db import connection
+    connection.creation.create_test_db(verbosity=0)
+
+
+def measure_ingest(name, fetch):
+    from django.db import connection, reset_queries
+    from odnoklassniki_discussions.metrics import api_metrics
+    from odnoklassniki_discussions.stats import counters
+
+    counters.reset()
+    reset_queries()
+    started = time.time()
+    items = fetch()
+    seconds = time.time() - started
+    if api_metrics:
+        api_metrics.finish_page()
+    queries = len(connection.queries)
+    print('%-15s %8d items %10.1f items/sec %8d API calls %8d queries %8.2f queries/item' % (
+        name, items, items / seconds if seconds else 0, counters['api_calls'], queries,
+        float(queries) / items if items else 0))
+
+
+def benchmark_ingest(args):
+    setup_django(ODNOKLASSNIKI_DISCUSSIONS_METRICS=args.metrics, ODNOKLASSNIKI_DISCUSSIONS_METRICS_LOG_INTERVAL=None)
+
+    from django.db import connection
+    from odnoklassniki_groups.models import Group
+    from odnoklassniki_discussions.metrics import api_metrics
+    from odnoklassniki_discussions.models import Discussion
+    from odnoklassniki_discussions.replay import Cassette, FakeApi, replace_api
+
+    if args.cassette:
+        api = Cassette(args.cassette)
+    else:
+        api = FakeApi(discussions=args.discussions, comments=args.comments, likes=args.likes, users=args.users,
+                      latency=args.latency)
+    if args.record:
+        recorder = Cassette()
+        api = recorder.record(api)
+
+    group = Group.objects.create(pk=args.group, name='Group')
+    connection.use_debug_cursor = True
+    with replace_api(api):
+        measure_ingest('fetch_group', lambda: Discussion.remote.fetch_group(group, all=True).count())
+        measure_ingest('fetch_comments', lambda: sum([discussion.fetch_comments(all=True, bulk=args.bulk).count()
+                                                      for discussion in Discussion.objects.all()]))
+        measure_ingest('fetch_likes', lambda: sum([discussion.fetch_likes(all=True).count()
+                                                   for discussion in Discussion.objects.all()]))
+
+    if api_metrics:
+        print(api_metrics.text())
+    if args.record:
+        recorder.save(args.record)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run benchmarks of odnoklassniki_discussions.")
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    parse_parser = subparsers.add_parser('parse', help='normalizing of discussions responses')
+    parse_parser.add_argument('--items', type=int, default=5000)
+    parse_parser.add_argument('--repeat', type=int, default=20)
+
+    ingest_parser = subparsers.add_parser('ingest', help='fetching and saving of discussions, comments and likes '
+                                                       'from fake API or from cassette of recorded API calls')
+    ingest_parser.add_argument('--group', type=int, default=47241470410797)
+    ingest_parser.add_argument('--discussions', type=int, default=100, help='discussions of group')
+    ingest_parser.add_argument('--comments', type=int, default=50, help='comments of each discussion')
+    ingest_parser.add_argument('--likes', type=int, default=20, help='likes of each discussion')
+    ingest_parser.add_argument('--users', type=int, default=500, help='different authors of comments and likes')
+    ingest_parser.add_argument('--latency', type=float, default=0, help='seconds of each fake API call')
+    ingest_parser.add_argument('--bulk', action='store_true', help='save comments by bulk_create')
+    ingest_parser.add_argument('--cassette', help='replay API calls from cassette instead of fake API')
+    ingest_parser.add_argument('--record', help='record API calls to cassette')
+    ingest_parser.add_argument('--metrics', action='store_true', help='print metrics of API calls')
+
+    args = parser.parse_args()
+    if args.benchmark == 'parse':
+        benchmark_parse(args.items, args.repeat)
+    elif args.benchmark == 'ingest':
+        benchmark_ingest(args)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+
+from django.conf import settings
+
+# directory of cache, responses are not cached if None
+API_CACHE_DIR = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_API_CACHE_DIR', None)
+# seconds of keeping responses of methods {'stream.get': 3600}, responses of method aren't cached if TTL is 0
+API_CACHE_TTLS = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_API_CACHE_TTLS', {})
+API_CACHE_TTL = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_API_CACHE_TTL', 24 * 60 * 60)
+API_CACHE_MAX_SIZE = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_API_CACHE_MAX_SIZE', 1024 ** 3)
+
+
+def get_key(method, params):
+    '''
+    Return key of API call, that doesn't depend on order of parameters
+    '''
+    return hashlib.sha1(json.dumps([method, params], sort_keys=True, default=unicode)).hexdigest()
+
+
+class ResponseCache(object):
+
+    '''
+    Cache of API responses in compressed files of directory `path`. Responses are keyed by method and parameters
+    and expire after TTL of method. If size of files is more than `max_size`, the oldest files are removed
+    '''
+
+    def __init__(self, path, ttls=None, ttl=API_CACHE_TTL, max_size=API_CACHE_MAX_SIZE):
+        self.path = path
+        self.ttls = ttls or {}
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+
+    def get_ttl(self, method):
+        return self.ttls.get(method, self.ttl)
+
+    def get_filename(self, method, params):
+        key = get_key(method, params)
+        return os.path.join(self.path, method, key[:2], key)
+
+    def get(self, method, params):
+        '''
+        Return cached response or None
+        '''
+        ttl = self.get_ttl(method)
+        if not ttl:
+            return None
+
+        filename = self.get_filename(method, params)
+        try:
+            if os.path.getmtime(filename) + ttl < time.time():
+                return None
+            with open(filename, 'rb') as f:
+                return json.loads(zlib.decompress(f.read()))
+        except (IOError, OSError, ValueError, zlib.error):
+            return None
+
+    def set(self, method, params, response):
+        if not self.get_ttl(method):
+            return
+
+        filename = self.get_filename(method, params)
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # directory was created by another thread
+                pass
+
+        data = zlib.compress(json.dumps(response))
+        fd, temp_filename = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp_filename, filename)
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum([size for filename, mtime, size in self.get_files()])
+            else:
+                self.size += len(data)
+            if self.size > self.max_size:
+                self.evict()
+
+    def get_files(self):
+        for directory, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                filename = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                yield filename, stat.st_mtime, stat.st_size
+
+    def evict(self):
+        '''
+        Remove the oldest files until size of cache is less than 90% of max_size
+        '''
+        files = sorted(self.get_files(), key=lambda file: file[1])
+        self.size = sum([size for filename, mtime, size in files])
+        for filename, mtime, size in files:
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            self.size -= size
+
+
+response_cache = ResponseCache(API_CACHE_DIR, API_CACHE_TTLS) if API_CACHE_DIR else None
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection
+
+from .metrics import api_metrics
+
+ASYNC_CONCURRENCY = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_ASYNC_CONCURRENCY', 10)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    '''
+    Return pool of threads shared by all async fetchers. Size of pool is the global limit of concurrent requests
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(ASYNC_CONCURRENCY)
+    return _pool
+
+
+def set_concurrency(concurrency):
+    '''
+    Replace the shared pool by the new one with `concurrency` threads. Requests of the old pool are finished
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = ThreadPool(concurrency)
+
+
+class RemoteFuture(object):
+
+    '''
+    Remote request running in the shared pool of threads. Callable `request` shouldn't write to DB,
+    it returns response or parsed instances, that are saved by callable `save` in the thread calling result().
+    Connection to DB opened by request (get() of timeline managers is wrapped by atomic) is closed after it
+    '''
+
+    def __init__(self, request, save):
+        self.request = request
+        self.save = save
+        self.response = None
+        self.error = None
+        self.saved = False
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        get_pool().apply_async(self.run)
+
+    def run(self):
+        try:
+            self.response = self.request()
+        except Exception, err:
+            self.error = err
+        finally:
+            connection.close()
+        if api_metrics:
+            # responses are processed by thread calling result(), so the last page of pool thread is finished here
+            api_metrics.finish_page()
+        with self.lock:
+            self.done.set()
+            callbacks = self.callbacks
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def ready(self):
+        return self.done.is_set()
+
+    def result(self, timeout=None):
+        '''
+        Wait for the response and return result of saving it. Raise exception of request if it failed
+        '''
+        if not self.done.wait(timeout):
+            raise RuntimeError("Remote request is not finished in %s seconds" % timeout)
+        if self.error is not None:
+            raise self.error
+        if not self.saved:
+            self.response = self.save(self.response)
+            self.saved = True
+        return self.response
+
+
+def as_completed(futures):
+    '''
+    Yield futures in order of finishing their requests
+    '''
+    queue = Queue.Queue()
+    for future in futures:
+        future.add_done_callback(queue.put)
+    for i in range(len(futures)):
+        yield queue.get()
+
+
+def imap_unordered(submit, items, window):
+    '''
+    Call `submit` for each item keeping not more than `window` futures not yielded,
+    so finished but not saved responses don't grow in memory. Yield pairs (item, future) in order of finishing
+    '''
+    queue = Queue.Queue()
+    items = iter(items)
+    pending = 0
+    while True:
+        for item in items:
+            future = submit(item)
+            future.add_done_callback(lambda future, item=item: queue.put((item, future)))
+            pending += 1
+            if pending >= window:
+                break
+        if not pending:
+            return
+        yield queue.get()
+        pending -= 1
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.utils import timezone
+from odnoklassniki_api.decorators import list_chunks_iterator
+from odnoklassniki_groups.models import Group
+
+from odnoklassniki_discussions.cache import response_cache
+from odnoklassniki_discussions.executor import imap_unordered, set_concurrency
+from odnoklassniki_discussions.metrics import api_metrics
+from odnoklassniki_discussions.models import (BULK_BATCH_SIZE, MEDIATOPICS_IDS_LIMIT, Discussion, Poll,
+                                              ref_resolver)
+from odnoklassniki_discussions.ratelimit import rate_limiter
+from odnoklassniki_discussions.stats import counters
+
+log = logging.getLogger('odnoklassniki_discussions')
+
+STAGES = ['posts', 'comments', 'likes', 'polls']
+DATE_FORMATS = ['%Y-%m-%d %H:%M', '%Y-%m-%d']
+
+
+class Command(BaseCommand):
+
+    args = '<group_id group_id ...>'
+    help = 'Fetch discussions of groups with comments, likes and polls by concurrent API requests'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=10, help='Number of concurrent API requests'),
+        make_option('--stages', default='posts,comments,likes',
+                    help='Comma separated stages from %s' % ', '.join(STAGES)),
+        make_option('--after', help='Fetch posts and comments after date "YYYY-MM-DD[ HH:MM]" in UTC'),
+        make_option('--before', help='Fetch posts and comments before date "YYYY-MM-DD[ HH:MM]" in UTC'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("IDs of groups should be specified")
+
+        stages = [stage.strip() for stage in options['stages'].split(',') if stage.strip()]
+        for stage in stages:
+            if stage not in STAGES:
+                raise CommandError("Unknown stage %s, available stages are %s" % (stage, ', '.join(STAGES)))
+
+        timeline = {}
+        for name in ['after', 'before']:
+            if options[name]:
+                timeline[name] = self.parse_date(options[name])
+        if 'before' in timeline and 'after' not in timeline:
+            raise CommandError("Option --before should be specified with option --after")
+
+        set_concurrency(options['workers'])
+        self.window = options['workers'] * 2
+        self.summary = []
+        self.queries = 0
+        counters.reset()
+
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        started = time.time()
+        try:
+            groups = self.get_groups([int(id) for id in args])
+
+            if 'posts' in stages:
+                self.run_stage('posts', groups,
+                               lambda group: Discussion.remote.fetch_group_async(group, all=True, **timeline),
+                               lambda discussions: discussions.count())
+
+            discussions = Discussion.objects.filter(
+                owner_content_type=ref_resolver.get_content_type('group'), owner_id__in=[group.pk for group in groups])
+            if 'after' in timeline:
+                discussions = discussions.filter(date__gte=timeline['after'])
+            if 'before' in timeline:
+                discussions = discussions.filter(date__lte=timeline['before'])
+            ids = list(discussions.values_list('pk', flat=True))
+
+            if 'comments' in stages:
+                self.run_stage('comments', self.iter_discussions(ids),
+                               lambda discussion: discussion.fetch_comments_async(all=True, **timeline),
+                               lambda comments: comments.count())
+            if 'likes' in stages:
+                self.run_stage('likes', self.iter_discussions(ids),
+                               lambda discussion: discussion.fetch_likes_async(),
+                               lambda users: users.count())
+            if 'polls' in stages:
+                self.run_polls_stage(discussions.exclude(question='').values_list('pk', flat=True))
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+            self.count_queries()
+
+        self.print_summary(time.time() - started)
+
+    def parse_date(self, value):
+        for format in DATE_FORMATS:
+            try:
+                return datetime.strptime(value, format).replace(tzinfo=timezone.utc)
+            except ValueError:
+                pass
+        raise CommandError("Wrong format of date %s" % value)
+
+    def get_groups(self, ids):
+        groups = list(Group.objects.filter(pk__in=ids))
+        ids_missed = set(ids).difference([group.pk for group in groups])
+        if ids_missed:
+            groups += list(Group.remote.fetch(ids=list(ids_missed)))
+        return groups
+
+    def iter_discussions(self, ids):
+        for chunk in list_chunks_iterator(ids, BULK_BATCH_SIZE):
+            for discussion in Discussion.objects.filter(pk__in=chunk):
+                yield discussion
+
+    def run_stage(self, name, items, submit, count):
+        '''
+        Submit remote requests for items and save responses in order of finishing, errors of items are only logged
+        '''
+        started = time.time()
+        number = errors = 0
+        for item, future in imap_unordered(submit, items, self.window):
+            try:
+                number += count(future.result())
+            except Exception, err:
+                errors += 1
+                log.error("Error on stage %s while fetching %s ID=%s: %s" %
+                          (name, item.__class__.__name__, item.pk, err))
+            self.count_queries()
+        self.summary.append((name, number, errors, time.time() - started))
+
+    def run_polls_stage(self, ids):
+        started = time.time()
+        number = errors = 0
+        for chunk in list_chunks_iterator(list(ids), MEDIATOPICS_IDS_LIMIT):
+            try:
+                number += Poll.remote.fetch(ids=chunk).count()
+            except Exception, err:
+                errors += 1
+                log.error("Error on stage polls while fetching discussions %s: %s" % (chunk, err))
+            self.count_queries()
+        self.summary.append(('polls', number, errors, time.time() - started))
+
+    def count_queries(self):
+        self.queries += len(connection.queries)
+        reset_queries()
+
+    def print_summary(self, seconds):
+        self.stdout.write('%-10s %10s %8s %10s %10s' % ('stage', 'items', 'errors', 'seconds', 'items/sec'))
+        items = 0
+        for name, number, errors, stage_seconds in self.summary:
+            items += number
+            self.stdout.write('%-10s %10d %8d %10.1f %10.1f' % (
+                name, number, errors, stage_seconds, number / stage_seconds if stage_seconds else 0))
+        self.stdout.write('Total: %d items in %.1f seconds, %.1f items/sec, %d API calls, %d DB queries' % (
+            items, seconds, items / seconds if seconds else 0, counters['api_calls'], self.queries))
+        if response_cache:
+            self.stdout.write('API response cache: %d hits' % counters['api_cache_hits'])
+        if rate_limiter:
+            self.stdout.write('API rate limiter: %.1f seconds of waiting, utilization %d%%' % (
+                counters['api_rate_wait'], rate_limiter.utilization() * 100))
+        if api_metrics:
+            api_metrics.finish_page()
+            self.stdout.write(api_metrics.text())
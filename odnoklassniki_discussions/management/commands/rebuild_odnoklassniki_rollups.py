@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from odnoklassniki_discussions.models import ref_resolver
+from odnoklassniki_discussions.rollups import engagement_rollup
+
+
+class Command(BaseCommand):
+
+    args = '[group_id group_id ...]'
+    help = ('Recompute daily engagement rollups of groups or of all owners by stored discussions and comments, '
+            'they are updated while fetching only with setting ODNOKLASSNIKI_DISCUSSIONS_ROLLUPS = True')
+
+    def handle(self, *args, **options):
+        if args:
+            count = engagement_rollup.rebuild(ref_resolver.get_content_type('group'), [int(id) for id in args])
+        else:
+            count = engagement_rollup.rebuild()
+        self.stdout.write('Rebuilt %d rows of daily engagement' % count)
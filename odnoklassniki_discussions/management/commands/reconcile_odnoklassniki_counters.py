@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from odnoklassniki_discussions.models import Discussion, ref_resolver
+
+
+class Command(BaseCommand):
+
+    args = '[group_id group_id ...]'
+    help = 'Recompute comments_count and likes_count of discussions of groups or all discussions by stored rows'
+
+    def handle(self, *args, **options):
+        discussions = Discussion.objects.all()
+        if args:
+            discussions = discussions.filter(owner_content_type=ref_resolver.get_content_type('group'),
+                                             owner_id__in=[int(id) for id in args])
+
+        count = Discussion.remote.reconcile_counters(discussions)
+        self.stdout.write('Updated counters of %d discussions' % count)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+
+from .signals import api_page_processed
+
+# collect metrics of API calls
+METRICS = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_METRICS', False)
+# seconds between log lines with metrics
+METRICS_LOG_INTERVAL = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_METRICS_LOG_INTERVAL', 60)
+# file rewritten with metrics text together with log line
+METRICS_FILE = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_METRICS_FILE', None)
+
+log = logging.getLogger('odnoklassniki_discussions')
+
+
+def get_items_count(response):
+    '''
+    Return length of the longest list in response, it's number of items on page
+    '''
+    if isinstance(response, list):
+        return len(response)
+    if isinstance(response, dict):
+        return max([get_items_count(value) for value in response.values()] or [0])
+    return 0
+
+
+class ApiMetrics(object):
+
+    '''
+    Metrics of API calls aggregated by method. Page of response is processed in the thread calling API
+    until the next API call of this thread or finish_page(): DB queries and time of processing are assigned to it.
+    Queries are counted by connection.queries only if settings.DEBUG or debug cursor of connection is enabled,
+    otherwise they are not counted, because debug cursor keeps all queries in memory
+    '''
+    fields = ('calls', 'seconds', 'bytes', 'items', 'queries', 'processing_seconds')
+
+    def __init__(self, log_interval=METRICS_LOG_INTERVAL, path=METRICS_FILE):
+        self.log_interval = log_interval
+        self.path = path
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.values = defaultdict(lambda: dict.fromkeys(self.fields, 0))
+        self.logged = time.time()
+
+    def get_queries_count(self):
+        '''
+        Return number of queries of connection or None if they aren't recorded
+        '''
+        if not connection.use_debug_cursor and not settings.DEBUG:
+            return None
+        return len(connection.queries)
+
+    def start_page(self, sender, method, seconds, response):
+        self.finish_page()
+        self.local.page = {
+            'sender': sender,
+            'method': method,
+            'seconds': seconds,
+            'size': len(json.dumps(response)),
+            'items': get_items_count(response),
+            'queries': self.get_queries_count(),
+            'started': time.time(),
+        }
+
+    def finish_page(self):
+        page = getattr(self.local, 'page', None)
+        if page is None:
+            return
+        self.local.page = None
+
+        queries = self.get_queries_count()
+        if queries is None or page['queries'] is None:
+            queries = None
+        elif queries >= page['queries']:
+            queries -= page['queries']
+        # otherwise queries were reset by somebody else while processing of page
+        processing_seconds = time.time() - page['started']
+
+        with self.lock:
+            values = self.values[page['method']]
+            values['calls'] += 1
+            values['seconds'] += page['seconds']
+            values['bytes'] += page['size']
+            values['items'] += page['items']
+            values['queries'] += queries or 0
+            values['processing_seconds'] += processing_seconds
+
+        api_page_processed.send(sender=page['sender'], method=page['method'], seconds=page['seconds'],
+                                size=page['size'], items=page['items'], queries=queries,
+                                processing_seconds=processing_seconds)
+        log.debug("API call %s: %.3f seconds, %d bytes, %d items, %s queries, %.3f seconds of processing" % (
+            page['method'], page['seconds'], page['size'], page['items'], queries, processing_seconds))
+
+        if self.log_interval and time.time() - self.logged >= self.log_interval:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write log line with metrics of all methods and rewrite metrics file
+        '''
+        self.logged = time.time()
+        methods = []
+        for method, values in sorted(self.get_values().items()):
+            calls = values['calls']
+            methods.append('%s %d calls, %.0f ms/call, %.1f items/call, %.1f queries/call, %.0f ms/call of processing'
+                           % (method, calls, values['seconds'] * 1000 / calls, float(values['items']) / calls,
+                              float(values['queries']) / calls, values['processing_seconds'] * 1000 / calls))
+        log.info("API metrics: %s" % '; '.join(methods))
+
+        if self.path:
+            fd, filename = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.text())
+            os.rename(filename, self.path)
+
+    def get_values(self):
+        '''
+        Return copy of dict {method: {field: value}}
+        '''
+        with self.lock:
+            return dict([(method, dict(values)) for method, values in self.values.items()])
+
+    def text(self):
+        '''
+        Return metrics in text format of Prometheus
+        '''
+        values = self.get_values()
+        lines = []
+        for field in self.fields:
+            name = 'odnoklassniki_api_%s_total' % field
+            lines.append('# TYPE %s counter' % name)
+            for method in sorted(values):
+                lines.append('%s{method="%s"} %s' % (name, method, values[method][field]))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+
+api_metrics = ApiMetrics() if METRICS else None
@@ -1,19 +1,36 @@
 # -*- coding: utf-8 -*-
+import copy
 import logging
-import re
+import Queue
+import threading
+import time
+from contextlib import contextmanager
 
+from django.conf import settings
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 from m2m_history.fields import ManyToManyHistoryField
-from odnoklassniki_api.decorators import atomic, fetch_all
+from odnoklassniki_api.decorators import atomic, fetch_all, list_chunks_iterator
 from odnoklassniki_api.fields import JSONField
 from odnoklassniki_api.models import (OdnoklassnikiModel, OdnoklassnikiPKModel,
                                       OdnoklassnikiTimelineManager, OdnoklassnikiManager)
 from odnoklassniki_users.models import User
 
+from .cache import response_cache
+from .executor import RemoteFuture, as_completed
+from .metrics import api_metrics
+from .normalizers import discussion_normalizer
+from .pagination import TimelineManager
+from .ratelimit import rate_limiter
+from .rollups import engagement_rollup
+from .scheduler import refresh_scheduler
+from .stats import counters
+
 log = logging.getLogger('odnoklassniki_discussions')
 
 DISCUSSION_TYPES = [
@@ -37,8 +54,196 @@ DISCUSSION_TYPE_CHOICES = [(type, type) for type in DISCUSSION_TYPES]
 COMMENT_TYPE_CHOICES = [(type, type) for type in COMMENT_TYPES]
 DISCUSSION_TYPE_DEFAULT = 'GROUP_TOPIC'
 
+BULK_BATCH_SIZE = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_BULK_BATCH_SIZE', 500)
+# max number of topic_ids for mediatopic.getByIds
+MEDIATOPICS_IDS_LIMIT = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_MEDIATOPICS_IDS_LIMIT', 100)
+
+
+class RefResolver(object):
+
+    '''
+    Resolver of references from responses like "group:123" to pairs (content_type, id).
+    Models are resolved by the name of application, content types of all known types are preloaded
+    by one query on first usage and then taken from cache of ContentTypeManager, so resolving doesn't touch DB
+    '''
+    types = ['user', 'group']
+
+    def __init__(self):
+        self.models = {}
+        self.preloaded = False
+
+    def get_model(self, type):
+        type = type.lower()
+        if type not in self.models:
+            model = models.get_model('odnoklassniki_%ss' % type, type)
+            if model is None:
+                raise ValueError("Unknown type of reference %s" % type)
+            self.models[type] = model
+        return self.models[type]
+
+    def get_content_type(self, type):
+        if not self.preloaded:
+            ContentType.objects.get_for_models(*[self.get_model(type) for type in self.types])
+            self.preloaded = True
+        return ContentType.objects.get_for_model(self.get_model(type))
+
+    def resolve(self, ref):
+        type, id = ref.split(':')
+        return self.get_content_type(type), int(id)
+
+ref_resolver = RefResolver()
+
+
+class RemoteManagerMixin(object):
+
+    '''
+    Limit rate of API calls of remote manager by the shared rate_limiter and count them in counters.
+    If response_cache is enabled, responses are taken from the cache without API calls.
+    If api_metrics is enabled, latency, size and processing of responses are measured
+    '''
+
+    def get_method_name(self, method):
+        name = self.methods[method]
+        if self.model.methods_namespace:
+            name = self.model.methods_namespace + '.' + name
+        return name
+
+    def api_call(self, method='get', **kwargs):
+        name = self.get_method_name(method)
+        if api_metrics:
+            api_metrics.finish_page()
+
+        response = response_cache.get(name, kwargs) if response_cache else None
+        if response is not None:
+            counters.incr('api_cache_hits')
+            seconds = 0
+        else:
+            if rate_limiter:
+                counters.incr('api_rate_wait', rate_limiter.acquire())
+            counters.incr('api_calls')
+            started = time.time()
+            response = super(RemoteManagerMixin, self).api_call(method, **kwargs)
+            seconds = time.time() - started
+            if response_cache:
+                response_cache.set(name, kwargs, response)
+
+        if api_metrics:
+            api_metrics.start_page(self.model, name, seconds, response)
+        return response
+
+
+def update_like_users(like_users, ids, remove=True):
+    '''
+    Write to history of like_users only difference between current users and `ids`.
+    Current users absent in `ids` are removed only if `remove` is True. Return number of users after update
+    '''
+    ids = set(ids)
+    ids_current = set(like_users.get_queryset(only_pk=True))
+
+    ids_added = list(ids.difference(ids_current))
+    for chunk in list_chunks_iterator(ids_added, BULK_BATCH_SIZE):
+        like_users.add(*chunk)
+
+    if not remove:
+        return len(ids_current) + len(ids_added)
+
+    ids_removed = list(ids_current.difference(ids))
+    for chunk in list_chunks_iterator(ids_removed, BULK_BATCH_SIZE):
+        like_users.remove(*chunk)
+
+    return len(ids)
+
+
+@contextmanager
+def savepoint():
+    '''
+    Roll back only queries of the block on error: by atomic() since Django 1.6 and by savepoint before
+    '''
+    if hasattr(transaction, 'atomic'):
+        with transaction.atomic():
+            yield
+        return
+
+    sid = transaction.savepoint()
+    try:
+        yield
+    except:
+        transaction.savepoint_rollback(sid)
+        raise
+    transaction.savepoint_commit(sid)
+
+
+def bulk_create_missing(model, instances):
+    '''
+    Insert instances selected as missing by one bulk query. If some of them were inserted by another process
+    after select, instances are inserted one by one and already existing rows are skipped
+    '''
+    if not instances:
+        return
+
+    def create(instances):
+        try:
+            with savepoint():
+                model.objects.bulk_create(instances)
+        except IntegrityError:
+            return False
+        return True
+
+    if not create(instances) and len(instances) > 1:
+        for instance in instances:
+            create([instance])
+
+
+def get_or_create_users(resources):
+    '''
+    Insert missing users from resources by one bulk query, existing users are not updated. Return IDs of users
+    '''
+    users = dict([(user.pk, user) for user in User.remote.parse_response_list(resources)])
+    ids_existing = set(User.objects.filter(pk__in=users.keys()).values_list('pk', flat=True))
+    bulk_create_missing(User, [user for id, user in users.items() if id not in ids_existing])
+    return users.keys()
+
+
+def fetch_like_users_ids(manager, like_users, all=False, incremental=False, **kwargs):
+    '''
+    Fetch users liked page by page, missing users of each page are inserted by one query.
+    If `incremental` is True, stop on the page without new users of like_users. Return set of IDs of users
+    '''
+    ids = set()
+    while True:
+        response = manager.api_call(method='get_likes', **kwargs)
+        if not response.get('users'):
+            break
+
+        ids_page = get_or_create_users(response['users'])
+        ids.update(ids_page)
+
+        # has_more not in dict and we need to handle pagination manualy
+        if not all or 'anchor' not in response:
+            break
+        if incremental and like_users.filter(pk__in=ids_page).count() == len(ids_page):
+            break
+        kwargs['anchor'] = response['anchor']
+
+    return ids
 
-class DiscussionRemoteManager(OdnoklassnikiTimelineManager):
+
+def get_likes_resources(manager, **kwargs):
+    '''
+    Request all pages of likes by anchor and return list of users resources, DB is not touched
+    '''
+    resources = []
+    while True:
+        response = manager.api_call(method='get_likes', **kwargs)
+        if not response.get('users'):
+            return resources
+        resources += response['users']
+        if 'anchor' not in response:
+            return resources
+        kwargs['anchor'] = response['anchor']
+
+
+class DiscussionRemoteManager(RemoteManagerMixin, OdnoklassnikiTimelineManager):
 
     @atomic
     def fetch_one(self, id, type, **kwargs):
@@ -77,67 +282,601 @@ class DiscussionRemoteManager(OdnoklassnikiTimelineManager):
 
         return super(DiscussionRemoteManager, self).parse_response(response, extra_fields)
 
+    def get_or_create_from_instances_list(self, instances):
+        self.set_entities_instances(instances)
+        with engagement_rollup.batch():
+            return super(DiscussionRemoteManager, self).get_or_create_from_instances_list(instances)
+
+    def set_entities_instances(self, instances):
+        '''
+        Get or create users and groups from entities, authors and owners of all instances by one query for each model
+        and store them in instance.entities_instances for assigning in Discussion.save()
+        '''
+        from odnoklassniki_groups.models import Group
+
+        resources = {User: [], Group: []}
+        ids = {User: set(), Group: set()}
+        for instance in instances:
+            if instance.entities:
+                resources[User] += instance.entities.get('users', [])
+                resources[Group] += instance.entities.get('groups', [])
+            for field in ['author', 'owner']:
+                content_type_id = getattr(instance, '%s_content_type_id' % field)
+                id = getattr(instance, '%s_id' % field)
+                if content_type_id and id:
+                    model = ContentType.objects.get_for_id(content_type_id).model_class()
+                    ids.setdefault(model, set()).add(int(id))
+
+        entities = {}
+        for model in ids:
+            entities[model] = self.get_or_create_entities(model, resources.get(model, []), ids[model])
+
+        for instance in instances:
+            instance.entities_instances = entities
+
+    def get_or_create_entities(self, model, resources, ids):
+        '''
+        Get or create instances of model from resources and from ids without resources.
+        Return dict {id: instance}
+        '''
+        instances = {}
+        for resource in resources:
+            instance = model()
+            instance.parse(dict(resource))
+            instances[instance.pk] = instance
+        for id in ids.difference(instances.keys()):
+            instances[id] = model(pk=id)
+
+        instances_existed = {}
+        for chunk in list_chunks_iterator(instances.keys(), BULK_BATCH_SIZE):
+            instances_existed.update([(instance.pk, instance) for instance in model.objects.filter(pk__in=chunk)])
+
+        instances_new = []
+        for id, instance in instances.items():
+            instance_existed = instances_existed.get(id)
+            if instance_existed is None:
+                instances_new += [instance]
+                continue
+
+            instance._substitute(instance_existed)
+            fields = instance._meta.local_fields
+            if [getattr(instance, f.attname) for f in fields] != [getattr(instance_existed, f.attname) for f in fields]:
+                instance.save()
+            else:
+                instances[id] = instance_existed
+
+        bulk_create_missing(model, instances_new)
+
+        return instances
+
 #     def update_discussions_count(self, instances, group, *args, **kwargs):
 #         group.discussions_count = len(instances)
 #         group.save()
 #         return instances
 
+    def fetch_group(self, group, resumable=False, as_generator=False, **kwargs):
+        '''
+        Fetch discussions of group. If `resumable` is True, each page is saved in own transaction
+        together with CrawlCheckpoint of pagination, so interrupted fetching continues from the last saved page.
+        If `as_generator` is True, return generator of discussions saved on each page
+        '''
+        if as_generator:
+            return self.fetch_group_by_pages(group, resumable=resumable, **kwargs)
+        if resumable:
+            return self.fetch_group_resumable(group, **kwargs)
+        return self.fetch_group_in_transaction(group=group, **kwargs)
+
     @atomic
     @fetch_all(has_more=None)
-    def fetch_group(self, group, count=100, **kwargs):
-        from odnoklassniki_groups.models import Group
+    def fetch_group_in_transaction(self, group, count=100, **kwargs):
+        discussions = super(DiscussionRemoteManager, self).fetch(**self.get_group_kwargs(group, count, **kwargs))
+        return discussions, self.response
+
+    def fetch_group_resumable(self, group, **kwargs):
+        '''
+        Return discussions fetched by this call
+        '''
+        ids = []
+        for discussions in self.fetch_group_by_pages(group, resumable=True, **kwargs):
+            ids += discussions.values_list('pk', flat=True)
+        return self.model.objects.filter(pk__in=ids)
 
+    def fetch_group_by_pages(self, group, all=False, count=100, resumable=False, **kwargs):
+        '''
+        Generator of discussions of group fetched page by page, each page is saved in own transaction.
+        If `resumable` is True, fetching starts from the anchor of checkpoint, that is saved after each page
+        and is reset after the last page
+        '''
+        kwargs = self.get_group_kwargs(group, count, **kwargs)
+        checkpoint = None
+        if resumable:
+            checkpoint = CrawlCheckpoint.objects.get_or_create(group=group, method=kwargs['method'])[0]
+            if checkpoint.anchor:
+                kwargs['anchor'] = checkpoint.anchor
+
+        while True:
+            with atomic():
+                instances = self.get(**kwargs)
+                discussions = self.get_or_create_from_instances_list(instances)
+                # has_more not in response and we need to handle pagination manualy
+                anchor = self.response.get('anchor') if all and instances else None
+                if checkpoint:
+                    checkpoint.anchor = anchor
+                    checkpoint.date = min([instance.date for instance in instances]) if anchor else None
+                    checkpoint.save()
+
+            yield discussions
+
+            if not anchor:
+                break
+            kwargs['anchor'] = anchor
+
+    def fetch_group_async(self, group, count=100, all=False, **kwargs):
+        '''
+        Async variant of fetch_group(), return RemoteFuture
+        '''
+        kwargs = self.get_group_kwargs(group, count, **kwargs)
+        # manager stores the last response in self.response, so request uses it's own copy
+        manager = copy.copy(self)
+        return RemoteFuture(lambda: list(manager.get(all=all, **kwargs)),
+                            atomic(self.get_or_create_from_instances_list))
+
+    def get_group_kwargs(self, group, count=100, **kwargs):
+        kwargs['method'] = 'stream'
         kwargs['gid'] = group.pk
         kwargs['count'] = int(count)
         kwargs['patterns'] = 'POST'
         kwargs['fields'] = self.get_request_fields('feed', 'media_topic', prefix=True)
         kwargs['extra_fields'] = {
-            'owner_id': group.pk, 'owner_content_type_id': ContentType.objects.get_for_model(Group).pk}
-
-        discussions = super(DiscussionRemoteManager, self).fetch(method='stream', **kwargs)
-        return discussions, self.response
+            'owner_id': group.pk, 'owner_content_type_id': ref_resolver.get_content_type('group').pk}
+        return kwargs
 
     @atomic
     def fetch_mediatopics(self, ids, **kwargs):
+        return super(DiscussionRemoteManager, self).fetch(**self.get_mediatopics_kwargs(ids, **kwargs))
+
+    def fetch_mediatopics_async(self, ids, save=None, **kwargs):
+        '''
+        Async variant of fetch_mediatopics(), return RemoteFuture.
+        Parsed discussions are saved by callable `save`, by default get_or_create_from_instances_list()
+        '''
+        kwargs = self.get_mediatopics_kwargs(ids, **kwargs)
+        # content types are preloaded here, so parsing in the pool doesn't touch DB
+        ref_resolver.get_content_type('group')
+        manager = copy.copy(self)
+        return RemoteFuture(lambda: manager.get(**kwargs), atomic(save or self.get_or_create_from_instances_list))
 
+    def refresh_many(self, queryset, chunk_size=MEDIATOPICS_IDS_LIMIT):
+        '''
+        Refresh counters of discussions from queryset by chunks of mediatopic.getByIds requested concurrently.
+        Return number of updated discussions
+        '''
+        futures = [self.fetch_mediatopics_async(chunk, save=self.update_counters)
+                   for chunk in list_chunks_iterator(list(queryset.values_list('pk', flat=True)), chunk_size)]
+        return sum([future.result() for future in as_completed(futures)])
+
+    def get_due(self, limit=1000):
+        '''
+        Return batch of discussions, that should be refreshed now, in order of scheduled time
+        '''
+        return self.model.objects.filter(
+            Q(refresh_at__lte=timezone.now()) | Q(refresh_at__isnull=True)).order_by('refresh_at')[:limit]
+
+    def refresh_due(self, limit=1000, **kwargs):
+        '''
+        Refresh counters of the batch of discussions, that should be refreshed now. Return number of updated discussions
+        '''
+        ids = list(self.get_due(limit).values_list('pk', flat=True))
+        return self.refresh_many(self.model.objects.filter(pk__in=ids), **kwargs)
+
+    def update_counters(self, instances):
+        '''
+        Update counters and time of the next refresh of existing discussions without saving instances.
+        Discussions with the same values are updated by one query
+        '''
+        fields = refresh_scheduler.fields
+        fetched = timezone.now()
+
+        groups = {}
+        for chunk in list_chunks_iterator(instances, BULK_BATCH_SIZE):
+            old_values = dict([(row[0], row[1:]) for row in self.model.objects.filter(
+                pk__in=[instance.pk for instance in chunk]).values_list(
+                'pk', 'owner_content_type_id', 'owner_id', 'object_type', 'date', 'last_activity_date', *fields)])
+            with engagement_rollup.batch():
+                for instance in chunk:
+                    if instance.pk not in old_values:
+                        continue
+                    owner_content_type_id, owner_id, object_type, date, last_activity_date = \
+                        old_values[instance.pk][:5]
+                    values = tuple([getattr(instance, field) for field in fields])
+                    old_counters = dict(zip(fields, old_values[instance.pk][5:]))
+                    changes = refresh_scheduler.get_changes(values, old_values[instance.pk][5:])
+                    refresh_at = refresh_scheduler.get_refresh_at(last_activity_date or date, changes, fetched)
+                    groups.setdefault(values + (refresh_at,), []).append(instance.pk)
+                    engagement_rollup.add(owner_content_type_id, owner_id, date, object_type, **dict([
+                        (field, (getattr(instance, field) or 0) - (old_counters[field] or 0))
+                        for field in ['likes_count', 'reshares_count']]))
+
+        count = 0
+        for values, ids in groups.items():
+            values = dict(zip(fields + ('refresh_at',), values), fetched=fetched)
+            for chunk in list_chunks_iterator(ids, BULK_BATCH_SIZE):
+                count += self.model.objects.filter(pk__in=chunk).update(**values)
+        return count
+
+    def reconcile_counters(self, queryset):
+        '''
+        Recompute comments_count and likes_count of discussions from queryset by stored comments and current
+        like users with one GROUP BY query for each counter and batch. Counters of discussions without stored
+        comments or likes are kept from API. Discussions with the same values are updated by one query.
+        Return number of updated discussions
+        '''
+        like_users = self.model.like_users.through.objects.filter(time_to=None)
+
+        count = 0
+        for chunk in list_chunks_iterator(list(queryset.values_list('pk', flat=True)), BULK_BATCH_SIZE):
+            comments_counts = dict(Comment.objects.filter(discussion__in=chunk).values_list('discussion')
+                                   .annotate(Count('pk')))
+            likes_counts = dict(like_users.filter(discussion__in=chunk).values_list('discussion')
+                                .annotate(Count('pk')))
+
+            groups = {}
+            for pk, comments_count, likes_count in self.model.objects.filter(pk__in=chunk).values_list(
+                    'pk', 'comments_count', 'likes_count'):
+                values = (comments_counts.get(pk, comments_count), likes_counts.get(pk, likes_count))
+                if values != (comments_count, likes_count):
+                    groups.setdefault(values, []).append(pk)
+
+            for (comments_count, likes_count), ids in groups.items():
+                count += self.model.objects.filter(pk__in=ids).update(comments_count=comments_count,
+                                                                       likes_count=likes_count)
+        return count
+
+    def get_mediatopics_kwargs(self, ids, **kwargs):
+        kwargs['method'] = 'mget'
         kwargs['topic_ids'] = ','.join(map(str, ids))
         kwargs['media_limit'] = 3
         if 'fields' not in kwargs:
             kwargs['fields'] = self.get_request_fields('media_topic', prefix=True)
+        return kwargs
+
+    def fetch_group_comments(self, group, workers=4, queue_size=10, **kwargs):
+        '''
+        Fetch comments of all discussions of group concurrently. Comments of `workers` discussions are requested
+        and parsed in threads at the same time, parsed comments are saved by the current thread from the queue
+        of maximum `queue_size` discussions, so memory is bounded and DB is written by one connection.
+        Failure of one discussion doesn't stop others.
+        Return tuple of dicts ({discussion: number of comments}, {discussion: exception})
+        '''
+        kwargs.setdefault('all', True)
+        complete = Comment.remote.is_complete(**kwargs)
+        # content types are preloaded here, so parsing in threads doesn't touch DB
+        discussions = list(self.model.objects.filter(owner_content_type=ref_resolver.get_content_type('group'),
+                                                     owner_id=group.pk))
+
+        tasks = Queue.Queue()
+        for discussion in discussions:
+            tasks.put(discussion)
+        results = Queue.Queue(maxsize=queue_size)
+
+        def worker():
+            # manager stores the last response in self.response, so each thread uses it's own copy
+            manager = copy.copy(Comment.remote)
+            try:
+                while True:
+                    try:
+                        discussion = tasks.get_nowait()
+                    except Queue.Empty:
+                        break
+                    try:
+                        results.put((discussion, manager.get(discussion=discussion, **kwargs), None))
+                    except Exception, err:
+                        results.put((discussion, None, err))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for i in range(min(workers, len(discussions)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        counts = {}
+        errors = {}
+        for i in range(len(discussions)):
+            discussion, instances, error = results.get()
+            if error is None:
+                try:
+                    counts[discussion] = Comment.remote.save_discussion_comments(discussion, instances,
+                                                                                 complete).count()
+                    continue
+                except Exception, err:
+                    error = err
+            log.error("Error while fetching comments of discussion %s: %s" % (discussion.pk, error))
+            errors[discussion] = error
+
+        for thread in threads:
+            thread.join()
 
-        return super(DiscussionRemoteManager, self).fetch(method='mget', **kwargs)
+        return counts, errors
 
 
-class CommentRemoteManager(OdnoklassnikiTimelineManager):
+class CommentRemoteManager(RemoteManagerMixin, OdnoklassnikiTimelineManager):
 
     def parse_response(self, response, extra_fields=None):
         return super(CommentRemoteManager, self).parse_response(response.get('comments', []), extra_fields)
 
     @fetch_all(has_more='has_more')
-    def get(self, discussion, count=100, **kwargs):
+    def get(self, discussion, count=100, since=None, **kwargs):
+        '''
+        If `since` is tuple (date, IDs of comments with this date) of already stored comments,
+        return only newer comments and stop paging on the page with stored comments
+        '''
         kwargs['discussionId'] = discussion.id
         kwargs['discussionType'] = discussion.object_type
         kwargs['count'] = int(count)
         kwargs['extra_fields'] = {'discussion_id': discussion.id}
 
         comments = super(CommentRemoteManager, self).get(**kwargs)
+        response = self.response
+
+        if since is not None:
+            date, ids = since
+            comments_new = [comment for comment in comments
+                            if comment.date > date or comment.date == date and comment.pk not in ids]
+            if len(comments_new) < len(comments):
+                response['has_more'] = False
+            comments = comments_new
 
-        return comments, self.response
+        return comments, response
 
     @atomic
-    def fetch(self, discussion, **kwargs):
+    def fetch(self, discussion, bulk=False, incremental=False, streaming=False, **kwargs):
         '''
-        Get all comments, reverse order and save them, because we need to store reply_to_comment relation
+        Get all comments and save them. Relations reply_to_comment of saved comments are linked after saving
+        all of them, so order of saving doesn't matter.
+        If `bulk` is True, save comments by batches using bulk_create instead of saving them one by one.
+        If `incremental` is True, get only comments newer than the last stored comment of discussion,
+        paging stops on the page with stored comments and only new comments are saved and returned.
+        If `streaming` is True, save each page by batches before requesting the next one,
+        so only IDs of comments are kept in memory instead of parsed comments
         '''
-        comments = super(CommentRemoteManager, self).fetch(discussion=discussion, **kwargs)
+        if incremental:
+            kwargs['since'] = self.get_since(discussion)
+            kwargs.setdefault('all', True)
 
-        discussion.comments_count = comments.count()
-        discussion.save()
+        if streaming:
+            comments, ids = self.fetch_by_pages(discussion, **kwargs)
+        else:
+            instances = self.get(discussion=discussion, **kwargs)
+            ids = self.save_instances(instances, bulk=bulk)
+            comments = self.model.objects.filter(pk__in=ids)
+
+        self.update_discussion(discussion, ids, self.is_complete(**kwargs))
 
         return comments
 
+    def fetch_by_pages(self, discussion, all=False, **kwargs):
+        '''
+        Get comments page by page and save each page by batches.
+        Return tuple (comments saved by this call, IDs of fetched comments)
+        '''
+        fetched = timezone.now()
+        ids = set()
+        while True:
+            instances = self.get(discussion=discussion, **kwargs)
+            ids.update(self.save_instances(instances))
+            if not all or not instances or not self.response.get('has_more', 'anchor' in self.response):
+                break
+            kwargs['anchor'] = self.response.get('anchor')
+
+        return discussion.comments.filter(fetched__gte=fetched), ids
+
+    def is_complete(self, all=False, after=None, before=None, since=None, **kwargs):
+        '''
+        Return True if arguments of get() mean fetching of all comments of discussion
+        '''
+        return bool(all) and after is None and before is None and since is None
+
+    def get_since(self, discussion):
+        '''
+        Return tuple (date, IDs of comments with this date) of the last stored comment of discussion
+        '''
+        try:
+            date = discussion.comments.order_by('-date').values_list('date', flat=True)[0]
+        except IndexError:
+            return None
+        return date, set(discussion.comments.filter(date=date).values_list('pk', flat=True))
 
-class PollRemoteManager(OdnoklassnikiManager):
+    def fetch_async(self, discussion, **kwargs):
+        '''
+        Async variant of fetch(), return RemoteFuture. Comments are saved by batches
+        '''
+        ref_resolver.get_content_type('user')
+        manager = copy.copy(self)
+        complete = self.is_complete(**kwargs)
+        return RemoteFuture(lambda: manager.get(discussion=discussion, **kwargs),
+                            lambda instances: self.save_discussion_comments(discussion, instances, complete))
+
+    @atomic
+    def save_discussion_comments(self, discussion, instances, complete=False):
+        '''
+        Save parsed comments of discussion by batches and update discussion.
+        `complete` means instances are all comments of discussion
+        '''
+        ids = self.save_instances(instances)
+        self.update_discussion(discussion, ids, complete)
+        return self.model.objects.filter(pk__in=ids)
+
+    def update_discussion(self, discussion, ids, complete=False):
+        '''
+        Link replies of saved comments with `ids` and update comments_count of discussion without COUNT query:
+        it's set to number of saved comments if they are `complete`, otherwise it keeps total number
+        of comments from API
+        '''
+        self.link_reply_to_comments(discussion, ids)
+
+        if complete:
+            discussion.comments_count = len(ids)
+            Discussion.objects.filter(pk=discussion.pk).update(comments_count=len(ids))
+
+    def save_instances(self, instances, bulk=True):
+        '''
+        Save parsed comments by batches or one by one if `bulk` is False.
+        Return set of IDs of comments
+        '''
+        ids = set([instance.pk for instance in instances])
+        if bulk:
+            self.bulk_save(instances)
+        else:
+            existing_ids = set()
+            for chunk in list_chunks_iterator(list(ids), BULK_BATCH_SIZE):
+                existing_ids.update(self.model.objects.filter(pk__in=chunk).values_list('pk', flat=True))
+            self.get_or_create_from_instances_list(instances)
+            instances_new = dict([(instance.pk, instance) for instance in instances
+                                  if instance.pk not in existing_ids]).values()
+            engagement_rollup.add_comments(instances_new)
+        return ids
+
+    def bulk_create_from_instances_list(self, instances):
+        '''
+        Save parsed comments by batches and return them
+        '''
+        if not instances:
+            return self.model.objects.none()
+
+        self.bulk_save(instances)
+        return self.model.objects.filter(pk__in=[instance.pk for instance in instances])
+
+    def bulk_save(self, instances):
+        '''
+        Save parsed comments with minimum of queries: existing comments are selected with their values by one query
+        for each batch, new comments are inserted by bulk_create, changed ones are updated one by one
+        and unchanged ones get only new time of fetching by one query.
+        Relations reply_to_comment are not saved here, they are staged in reply_to_comment_remote_id
+        and should be linked by link_reply_to_comments() after all comments are saved.
+        Inserted comments are added to rollups and returned
+        '''
+        self.set_authors(instances)
+        for instance in instances:
+            instance.set_reply_to_author_content_type()
+            instance.reply_to_comment = None
+
+        fields = [field for field in self.model._meta.local_fields if not field.primary_key]
+        instances_new = []
+        for chunk in list_chunks_iterator(instances, BULK_BATCH_SIZE):
+            stored_values = dict([(row[0], row[1:]) for row in self.model.objects.filter(
+                pk__in=[instance.pk for instance in chunk]).values_list('pk', *[field.attname for field in fields])])
+            chunk_new = [instance for instance in chunk if instance.pk not in stored_values]
+            self.model.objects.bulk_create(chunk_new)
+            instances_new += chunk_new
+
+            unchanged = {}
+            for instance in chunk:
+                if instance.pk not in stored_values:
+                    continue
+                values = self.get_update_values(instance)
+                stored = dict([(field.name, field.to_python(value))
+                               for field, value in zip(fields, stored_values[instance.pk])])
+                if [name for name, value in values.items() if name != 'fetched' and stored[name] != value]:
+                    self.model.objects.filter(pk=instance.pk).update(**values)
+                else:
+                    unchanged.setdefault(values.get('fetched'), []).append(instance.pk)
+            for fetched, ids in unchanged.items():
+                if fetched is not None:
+                    self.model.objects.filter(pk__in=ids).update(fetched=fetched)
+
+        engagement_rollup.add_comments(instances_new)
+        return instances_new
+
+    def get_or_create_from_instances_list(self, instances):
+        self.set_authors(instances)
+        return super(CommentRemoteManager, self).get_or_create_from_instances_list(instances)
+
+    def set_authors(self, instances):
+        '''
+        Set owner and author for all instances: authors are selected by one query for each type,
+        missed ones are fetched by one remote request for each type
+        '''
+        from odnoklassniki_groups.models import Group
+
+        discussions = {}
+        authors_ids = {User: set(), Group: set()}
+        for instance in instances:
+            if instance.discussion_id not in discussions:
+                discussions[instance.discussion_id] = instance.discussion
+            instance.discussion = discussions[instance.discussion_id]
+            instance.owner = instance.discussion.owner
+            if instance.author_id and not (instance.author_type == 'GROUP' and instance.author_id == instance.owner_id):
+                authors_ids[Group if instance.author_type == 'GROUP' else User].add(instance.author_id)
+
+        authors = {}
+        for model, ids in authors_ids.items():
+            authors[model] = {}
+            for chunk in list_chunks_iterator(list(ids), BULK_BATCH_SIZE):
+                authors[model].update([(author.pk, author) for author in model.objects.filter(pk__in=chunk)])
+            ids_missed = ids.difference(authors[model].keys())
+            if ids_missed:
+                authors[model].update([(author.pk, author) for author in model.remote.fetch(ids=list(ids_missed))])
+
+        for instance in instances:
+            if not instance.author_id:
+                continue
+            if instance.author_type == 'GROUP':
+                if instance.author_id == instance.owner_id:
+                    instance.author = instance.owner
+                    continue
+                model = Group
+            else:
+                model = User
+            try:
+                instance.author = authors[model][instance.author_id]
+            except KeyError:
+                raise Exception("Can't fetch Odnoklassniki comment's %s-author with ID %s" %
+                                (model.__name__.lower(), instance.author_id))
+
+    def link_reply_to_comments(self, discussion, ids=None):
+        '''
+        Link reply_to_comment relations of comments of discussion staged in reply_to_comment_remote_id.
+        If `ids` of saved comments are given, only their replies and replies to them are linked,
+        otherwise all comments of discussion are checked.
+        Replies with stored parents are selected first and then linked by UPDATE for each batch,
+        because MySQL doesn't update table with subquery on the same table.
+        Comments with parents, that doesn't exist in DB, stay unlinked until their parents are saved.
+        Return number of linked
+        '''
+        replies = self.model.objects.filter(discussion=discussion, reply_to_comment__isnull=True)
+        parents = self.model.objects.filter(discussion=discussion).values('pk')
+        if ids is None:
+            replies_ids = list(replies.filter(reply_to_comment_remote_id__in=parents).values_list('pk', flat=True))
+        else:
+            replies_ids = set()
+            for chunk in list_chunks_iterator(list(ids), BULK_BATCH_SIZE):
+                replies_ids.update(replies.filter(
+                    Q(pk__in=chunk, reply_to_comment_remote_id__in=parents) | Q(reply_to_comment_remote_id__in=chunk),
+                ).values_list('pk', flat=True))
+            replies_ids = list(replies_ids)
+
+        count = 0
+        for chunk in list_chunks_iterator(replies_ids, BULK_BATCH_SIZE):
+            count += self.model.objects.filter(pk__in=chunk).update(reply_to_comment=F('reply_to_comment_remote_id'))
+        return count
+
+    def get_update_values(self, instance):
+        '''
+        Return dict of not empty values of instance for updating existing row,
+        empty values are not updated the same way as in OdnoklassnikiModel._substitute()
+        '''
+        values = {}
+        for field in instance._meta.local_fields:
+            if field.primary_key:
+                continue
+            value = getattr(instance, field.attname)
+            if value is not None and value != '':
+                values[field.name] = value
+        return values
+
+
+class PollRemoteManager(RemoteManagerMixin, OdnoklassnikiManager):
     methods_namespace = 'polls'
 
     @atomic
@@ -154,7 +893,7 @@ class PollRemoteManager(OdnoklassnikiManager):
         return super(PollRemoteManager, self).fetch(method='mget', **kwargs)
 
 
-class AnswerRemoteManager(OdnoklassnikiManager):
+class AnswerRemoteManager(RemoteManagerMixin, OdnoklassnikiManager):
     methods_namespace = 'polls'
 
     @fetch_all(always_all=True)
@@ -201,6 +940,11 @@ class Discussion(OdnoklassnikiPKModel):
     methods_namespace = ''
     remote_pk_field = 'object_id'
 
+    # temporary variable for distance from remote manager to save()
+    entities_instances = None
+    # temporary variable for distance from _substitute() to save(), stored version of discussion
+    stored_instance = None
+
     owner_content_type = models.ForeignKey(ContentType, related_name='odnoklassniki_discussions_owners')
     owner_id = models.BigIntegerField(db_index=True)
     owner = generic.GenericForeignKey('owner_content_type', 'owner_id')
@@ -233,8 +977,12 @@ class Discussion(OdnoklassnikiPKModel):
     ref_objects = JSONField(null=True)
     attrs = JSONField(null=True)
 
+    # time of the next refresh by RefreshScheduler
+    refresh_at = models.DateTimeField(null=True, db_index=True)
+
     like_users = ManyToManyHistoryField(User, related_name='like_discussions')
 
+    objects = TimelineManager()
     remote = DiscussionRemoteManager(methods={
         'get': 'discussions.getList',
         'get_one': 'discussions.get',
@@ -257,56 +1005,55 @@ class Discussion(OdnoklassnikiPKModel):
                 self.entities['themes'][0]['images'][0] = old_instance.entities['themes'][0]['images'][0]
         except (KeyError, TypeError):
             pass
+        refresh_scheduler.schedule(self, old_instance)
+        self.stored_instance = old_instance
 
     def save(self, *args, **kwargs):
+        from odnoklassniki_groups.models import Group
 
-        # make 2 dicts {id: instance} for group and users from entities
-        if self.entities:
-            entities = {
-                'users': [],
-                'groups': [],
-            }
-            for resource in self.entities.get('users', []):
-                entities['users'] += [User.remote.get_or_create_from_resource(resource)]
-            for resource in self.entities.get('groups', []):
-                from odnoklassniki_groups.models import Group
-                entities['groups'] += [Group.remote.get_or_create_from_resource(resource)]
-            for field in ['users', 'groups']:
-                entities[field] = dict([(instance.id, instance) for instance in entities[field]])
+        # make dicts {id: instance} for groups and users from entities, authors and owners only for instance
+        # created from response, saves of stored instances (counters, refreshing) don't resolve them again
+        if self.entities_instances is None and self._state.adding:
+            Discussion.remote.set_entities_instances([self])
+        entities = self.entities_instances
 
+        if self.entities and entities is not None:
             # set owner
             if self.ref_objects:
                 for resource in self.ref_objects:
                     id = int(resource['id'])
                     if resource['type'] == 'GROUP':
-                        self.owner = entities['groups'][id]
+                        self.owner = entities[Group][id]
                     elif resource['type'] == 'USER':
-                        self.owner = entities['user'][id]
+                        self.owner = entities[User][id]
                     else:
                         log.warning("Strange type of object in ref_objects %s for duscussion ID=%s" % (resource, self.id))
 
             # set author
             if self.author_id:
-                if self.author_id in entities['groups']:
-                    self.author = entities['groups'][self.author_id]
-                elif self.author_id in entities['users']:
-                    self.author = entities['users'][self.author_id]
+                if self.author_id in entities[Group]:
+                    self.author = entities[Group][self.author_id]
+                elif self.author_id in entities[User]:
+                    self.author = entities[User][self.author_id]
                 else:
                     log.warning("Imposible to find author with ID=%s in entities of duscussion ID=%s" %
                                 (self.author_id, self.id))
                     self.author_id = None
 
-        if self.owner and not self.author_id:
+        if self.owner_id and not self.author_id:
             # of no author_id (owner_uid), so it's equal to owner from ref_objects
-            self.author = self.owner
+            self.author_content_type_id, self.author_id = self.owner_content_type_id, self.owner_id
 
-        if self.author_id and not self.author:
-            self.author = self.author_content_type.model_class().objects.get_or_create(pk=self.author_id)[0]
+        self.entities_instances = None
 
-        if self.owner_id and not self.owner:
-            self.owner = self.owner_content_type.model_class().objects.get_or_create(pk=self.owner_id)[0]
+        if self.refresh_at is None:
+            refresh_scheduler.schedule(self)
 
-        return super(Discussion, self).save(*args, **kwargs)
+        adding, stored_instance, self.stored_instance = self._state.adding, self.stored_instance, None
+        result = super(Discussion, self).save(*args, **kwargs)
+        if adding:
+            engagement_rollup.add_discussion(self, stored_instance)
+        return result
 
     @property
     def refresh_kwargs(self):
@@ -317,99 +1064,65 @@ class Discussion(OdnoklassnikiPKModel):
         return '%s/topic/%s' % (self.owner.slug, self.id)
 
     def parse(self, response):
-        from odnoklassniki_groups.models import Group
-        if 'discussion' in response:
-            response.update(response.pop('discussion'))
-
-        # Discussion.remote.fetch_one
-        if 'entities' in response and 'media_topics' in response['entities'] \
-            and len(response['entities']['media_topics']) == 1:
-                response.update(response['entities'].pop('media_topics')[0])
-                if 'polls' in response['entities']:
-                    response.update(response['entities'].pop('polls')[0])
-                    if 'vote_summary' in response:
-                        response['last_vote_date'] = response['vote_summary']['last_vote_date_ms'] / 1000
-                        response['votes_count'] = response['vote_summary']['count']
-
-
-
-
-
-        # media_topics
-        if 'like_summary' in response:
-            response['likes_count'] = response['like_summary']['count']
-            response.pop('like_summary')
-        if 'reshare_summary' in response:
-            response['reshares_count'] = response['reshare_summary']['count']
-            response.pop('reshare_summary')
-        if 'discussion_summary' in response:
-            response['comments_count'] = response['discussion_summary']['comments_count']
-            response.pop('discussion_summary')
-        if 'author_ref' in response:
-            i = response.pop('author_ref').split(':')
-            response['author_id'] = i[1]
-            self.author_content_type = ContentType.objects.get(app_label='odnoklassniki_%ss' % i[0], model=i[0])
-        if 'owner_ref' in response:
-            i = response.pop('owner_ref').split(':')
-            response['owner_id'] = i[1]
-            self.owner_content_type = ContentType.objects.get(app_label='odnoklassniki_%ss' % i[0], model=i[0])
-        if 'created_ms' in response:
-            response['date'] = response.pop('created_ms') / 1000
-        if 'media' in response:
-            response['title'] = response['media'][0]['text']
-
-        # in API owner is author
-        if 'owner_uid' in response:
-            response['author_id'] = response.pop('owner_uid')
-
-        # some name cleaning
-        if 'like_count' in response:
-            response['likes_count'] = response.pop('like_count')
-
-        if 'total_comments_count' in response:
-            response['comments_count'] = response.pop('total_comments_count')
-
-        if 'creation_date' in response:
-            response['date'] = response.pop('creation_date')
-
-        # response of stream.get has another format
-        if 'message' in response and '{media_topic' in response['message']:
-            regexp = r'{media_topic:?(\d+)?}'
-            m = re.findall(regexp, response['message'])
-            if len(m):
-                response['id'] = m[0]
-                response['message'] = re.sub(regexp, '', response['message'])
+        refs = discussion_normalizer.normalize(response)
+        for field, type in refs.items():
+            setattr(self, '%s_content_type' % field, ref_resolver.get_content_type(type))
 
         return super(Discussion, self).parse(response)
 
     def fetch_comments(self, **kwargs):
         return Comment.remote.fetch(discussion=self, **kwargs)
 
-    def update_likes_count(self, instances, *args, **kwargs):
-        users = User.objects.filter(pk__in=instances)
-        self.like_users = users
-        self.likes_count = len(instances)
+    def fetch_comments_async(self, **kwargs):
+        return Comment.remote.fetch_async(discussion=self, **kwargs)
+
+    def update_likes_count(self, instances, incremental=False, complete=True):
+        '''
+        Write users to history of like_users and update likes_count. If `complete` is False, `instances` are
+        only part of users liked, so they are only added and likes_count is kept
+        '''
+        if not complete:
+            update_like_users(self.like_users, instances, remove=False)
+            return self.like_users.all()
+
+        likes_count = self.likes_count
+        self.likes_count = update_like_users(self.like_users, instances, remove=not incremental)
         self.save()
-        return users
+        engagement_rollup.add(self.owner_content_type_id, self.owner_id, self.date, self.object_type,
+                              likes_count=self.likes_count - (likes_count or 0))
+        return self.like_users.all()
+
+    @atomic
+    def fetch_likes(self, count=100, all=False, incremental=False, **kwargs):
+        '''
+        Fetch users liked and write to history of like_users only difference with current users.
+        If `all` is False, only users of the first page are added, likes_count is kept.
+        If `incremental` is True, fetching stops on the page without new users and users are only added
+        '''
+        ids = fetch_like_users_ids(Discussion.remote, self.like_users, all=all, incremental=incremental,
+                                   **self.get_likes_kwargs(count, **kwargs))
+        return self.update_likes_count(ids, incremental=incremental, complete=all)
+
+    def fetch_likes_async(self, count=100, **kwargs):
+        '''
+        Async variant of fetch_likes(), return RemoteFuture
+        '''
+        kwargs = self.get_likes_kwargs(count, **kwargs)
+        return RemoteFuture(lambda: get_likes_resources(Discussion.remote, **kwargs), self.save_likes)
 
     @atomic
-    @fetch_all(return_all=update_likes_count, has_more=None)
-    def fetch_likes(self, count=100, **kwargs):
+    def save_likes(self, resources):
+        ids = set()
+        for chunk in list_chunks_iterator(resources, BULK_BATCH_SIZE):
+            ids.update(get_or_create_users(chunk))
+        return self.update_likes_count(ids)
+
+    def get_likes_kwargs(self, count=100, **kwargs):
         kwargs['discussionId'] = self.id
         kwargs['discussionType'] = self.object_type
         kwargs['count'] = int(count)
 #        kwargs['fields'] = Discussion.remote.get_request_fields('user')
-
-        response = Discussion.remote.api_call(method='get_likes', **kwargs)
-        # has_more not in dict and we need to handle pagination manualy
-        if 'users' not in response:
-            response.pop('anchor', None)
-            users_ids = []
-        else:
-            users_ids = list(User.remote.get_or_create_from_resources_list(
-                response['users']).values_list('pk', flat=True))
-
-        return users_ids, response
+        return kwargs
 
 
 class Comment(OdnoklassnikiModel):
@@ -433,6 +1146,8 @@ class Comment(OdnoklassnikiModel):
     author = generic.GenericForeignKey('author_content_type', 'author_id')
 
     reply_to_comment = models.ForeignKey('self', null=True, verbose_name=u'Это ответ на комментарий')
+    # raw ID of reply_to_comment from response, parent may be not saved yet
+    reply_to_comment_remote_id = models.CharField(max_length=68, null=True, db_index=True)
 
     reply_to_author_content_type = models.ForeignKey(
         ContentType, null=True, related_name='odnoklassniki_comments_reply_to_authors')
@@ -451,6 +1166,7 @@ class Comment(OdnoklassnikiModel):
 
     like_users = ManyToManyHistoryField(User, related_name='like_comments')
 
+    objects = TimelineManager()
     remote = CommentRemoteManager(methods={
         'get': 'getComments',
         'get_one': 'getComment',
@@ -467,7 +1183,12 @@ class Comment(OdnoklassnikiModel):
 
     def save(self, *args, **kwargs):
         self.owner = self.discussion.owner
+        self.set_author()
+        self.set_reply_to_author_content_type()
+        # parent may be not saved yet, so reply_to_comment is linked by CommentRemoteManager.link_reply_to_comments()
+        return super(Comment, self).save(*args, **kwargs)
 
+    def set_author(self):
         if self.author_id and not self.author:
             if self.author_type == 'GROUP':
                 if self.author_id == self.owner_id:
@@ -487,26 +1208,16 @@ class Comment(OdnoklassnikiModel):
                     except IndexError:
                         raise Exception("Can't fetch Odnoklassniki comment's user-author with ID %s" % self.author_id)
 
+    def set_reply_to_author_content_type(self):
         # it's hard to get proper reply_to_author_content_type in case we fetch comments from last
         if self.reply_to_author_id and not self.reply_to_author_content_type:
-            self.reply_to_author_content_type = ContentType.objects.get_for_model(User)
+            self.reply_to_author_content_type = ref_resolver.get_content_type('user')
 #         if self.reply_to_comment_id and self.reply_to_author_id and not self.reply_to_author_content_type:
 #             try:
 #                 self.reply_to_author = User.objects.get(pk=self.reply_to_author_id)
 #             except User.DoesNotExist:
 #                 self.reply_to_author = self.reply_to_comment.author
 
-        # check for existing comment from self.reply_to_comment to prevent ItegrityError
-        if self.reply_to_comment_id:
-            try:
-                self.reply_to_comment = Comment.objects.get(pk=self.reply_to_comment_id)
-            except Comment.DoesNotExist:
-                log.error("Try to save comment ID=%s with reply_to_comment_id=%s that doesn't exist in DB" %
-                          (self.id, self.reply_to_comment_id))
-                self.reply_to_comment = None
-
-        return super(Comment, self).save(*args, **kwargs)
-
     def parse(self, response):
         # rename becouse discussion has object_type
         if 'type' in response:
@@ -517,41 +1228,64 @@ class Comment(OdnoklassnikiModel):
         if 'reply_to_id' in response:
             response['reply_to_author_id'] = response.pop('reply_to_id')
         if 'reply_to_comment_id' in response:
-            response['reply_to_comment'] = response.pop('reply_to_comment_id')
+            self.reply_to_comment_remote_id = response.pop('reply_to_comment_id')
 
         # if author is a group
         if 'author_type' in response:
             response.pop('author_name')
             self.author_type = response.pop('author_type')
+        if 'author_id' in response:
+            self.author_content_type = ref_resolver.get_content_type('group' if self.author_type == 'GROUP' else 'user')
+        if 'reply_to_author_id' in response:
+            self.reply_to_author_content_type = ref_resolver.get_content_type('user')
 
         return super(Comment, self).parse(response)
 
-    def update_likes_count(self, instances, *args, **kwargs):
-        users = User.objects.filter(pk__in=instances)
-        self.like_users = users
-        self.likes_count = len(instances)
+    def update_likes_count(self, instances, incremental=False, complete=True):
+        '''
+        Write users to history of like_users and update likes_count. If `complete` is False, `instances` are
+        only part of users liked, so they are only added and likes_count is kept
+        '''
+        if not complete:
+            update_like_users(self.like_users, instances, remove=False)
+            return self.like_users.all()
+
+        self.likes_count = update_like_users(self.like_users, instances, remove=not incremental)
         self.save()
-        return users
+        return self.like_users.all()
 
     @atomic
-    @fetch_all(return_all=update_likes_count, has_more=None)
-    def fetch_likes(self, count=100, **kwargs):
+    def fetch_likes(self, count=100, all=False, incremental=False, **kwargs):
+        '''
+        Fetch users liked and write to history of like_users only difference with current users.
+        If `all` is False, only users of the first page are added, likes_count is kept.
+        If `incremental` is True, fetching stops on the page without new users and users are only added
+        '''
+        ids = fetch_like_users_ids(Comment.remote, self.like_users, all=all, incremental=incremental,
+                                   **self.get_likes_kwargs(count, **kwargs))
+        return self.update_likes_count(ids, incremental=incremental, complete=all)
+
+    def fetch_likes_async(self, count=100, **kwargs):
+        '''
+        Async variant of fetch_likes(), return RemoteFuture
+        '''
+        kwargs = self.get_likes_kwargs(count, **kwargs)
+        return RemoteFuture(lambda: get_likes_resources(Comment.remote, **kwargs), self.save_likes)
+
+    @atomic
+    def save_likes(self, resources):
+        ids = set()
+        for chunk in list_chunks_iterator(resources, BULK_BATCH_SIZE):
+            ids.update(get_or_create_users(chunk))
+        return self.update_likes_count(ids)
+
+    def get_likes_kwargs(self, count=100, **kwargs):
         kwargs['comment_id'] = self.id
         kwargs['discussionId'] = self.discussion.id
         kwargs['discussionType'] = self.discussion.object_type
         kwargs['count'] = int(count)
 #        kwargs['fields'] = Comment.remote.get_request_fields('user')
-
-        response = Comment.remote.api_call(method='get_likes', **kwargs)
-        # has_more not in dict and we need to handle pagination manualy
-        if 'users' not in response:
-            response.pop('anchor', None)
-            users_ids = []
-        else:
-            users_ids = list(User.remote.get_or_create_from_resources_list(
-                response['users']).values_list('pk', flat=True))
-
-        return users_ids, response
+        return kwargs
 
 
 class Poll(OdnoklassnikiModel):
@@ -603,13 +1337,9 @@ class Poll(OdnoklassnikiModel):
 
         # owner
         if 'author_ref' in poll:
-            i = poll.pop('author_ref').split(':')
-            response['author_id'] = i[1]
-            self.author_content_type = ContentType.objects.get(app_label='odnoklassniki_%ss' % i[0], model=i[0])
+            self.author_content_type, response['author_id'] = ref_resolver.resolve(poll.pop('author_ref'))
         if 'owner_ref' in poll:
-            i = poll.pop('owner_ref').split(':')
-            response['owner_id'] = i[1]
-            self.owner_content_type = ContentType.objects.get(app_label='odnoklassniki_%ss' % i[0], model=i[0])
+            self.owner_content_type, response['owner_id'] = ref_resolver.resolve(poll.pop('owner_ref'))
 
 
 
@@ -723,3 +1453,48 @@ class Answer(OdnoklassnikiModel):
 
     def fetch_voters_by_api(self, **kwargs):
         return Answer.remote.fetch_voters(answer=self, **kwargs)
+
+
+class CrawlCheckpoint(models.Model):
+
+    '''
+    Position of paginated fetching of group by remote method, it's saved after each page
+    '''
+    group = models.ForeignKey('odnoklassniki_groups.Group', related_name='odnoklassniki_discussions_checkpoints')
+    method = models.CharField(max_length=20)
+
+    anchor = models.CharField(max_length=200, null=True)
+    date = models.DateTimeField(u'Дата последнего сохраненного объекта', null=True)
+
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _('Odnoklassniki crawl checkpoint')
+        verbose_name_plural = _('Odnoklassniki crawl checkpoints')
+        unique_together = ('group', 'method')
+
+
+class DailyEngagement(models.Model):
+
+    '''
+    Rollup of discussions and comments of owner by day and type of discussion, it's updated while saving them
+    by EngagementRollup only if setting ODNOKLASSNIKI_DISCUSSIONS_ROLLUPS is True, otherwise rows are written
+    only by command rebuild_odnoklassniki_rollups. Likes and reshares are counters of discussions published this day
+    '''
+    owner_content_type = models.ForeignKey(ContentType, related_name='odnoklassniki_discussions_daily_engagements')
+    owner_id = models.BigIntegerField()
+    owner = generic.GenericForeignKey('owner_content_type', 'owner_id')
+
+    date = models.DateField()
+    object_type = models.CharField(max_length=20, choices=DISCUSSION_TYPE_CHOICES)
+
+    # counters are changed by increments, so they could be negative until rebuild
+    discussions_count = models.IntegerField(default=0)
+    comments_count = models.IntegerField(default=0)
+    likes_count = models.IntegerField(default=0)
+    reshares_count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = _('Odnoklassniki daily engagement')
+        verbose_name_plural = _('Odnoklassniki daily engagements')
+        unique_together = ('owner_content_type', 'owner_id', 'date', 'object_type')
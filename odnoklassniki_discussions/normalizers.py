@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import re
+
+MEDIA_TOPIC_RE = re.compile(r'{media_topic:?(\d+)?}')
+
+
+class ResponseNormalizer(object):
+
+    '''
+    Declarative normalizer of API response keys to names of model fields. Tables of child classes:
+     * `unwraps` - [key], nested dicts merged into response
+     * `hooks` - [(key, substring, method name)], methods called with response and dict of references
+       if key is in response and value of key contains substring (if it's not None)
+     * `firsts` - {key: (key of item, field)}, value of the first item of list copied to field
+     * `summaries` - {key: (key of summary, field)}, nested summaries flattened to field
+     * `refs` - {key: field}, references like "group:123" splitted to field_id and returned type of reference
+     * `timestamps_ms` - {key: field}, timestamps in milliseconds converted to seconds
+     * `renames` - {key: field}, keys renamed to field
+    Steps are applied in this order. normalize(response) modifies response in place
+    and returns dict {field: type of reference}.
+    Table `shapes` - [(marker key, [keys])] lists shapes of responses: response with marker key has only
+    these keys of tables, so only their steps are checked. Responses of other shapes are checked by all steps
+    '''
+    unwraps = []
+    hooks = []
+    firsts = {}
+    summaries = {}
+    refs = {}
+    timestamps_ms = {}
+    renames = {}
+    shapes = []
+
+    def __init__(self):
+        # tables are converted once to tuples of steps for each shape, that are faster to iterate
+        self.steps = self.get_steps()
+        self.shapes_steps = tuple([(marker, self.get_steps(set(keys))) for marker, keys in self.shapes])
+
+    def get_steps(self, keys=None):
+        '''
+        Return tuple of tables converted to tuples of steps, only steps of `keys` if they are given
+        '''
+        return (
+            tuple([key for key in self.unwraps if keys is None or key in keys]),
+            tuple([(key, substring, getattr(self, method)) for key, substring, method in self.hooks
+                   if keys is None or key in keys]),
+            tuple([(key, item_key, field) for key, (item_key, field) in self.firsts.items()
+                   if keys is None or key in keys]),
+            tuple([(key, summary_key, field) for key, (summary_key, field) in self.summaries.items()
+                   if keys is None or key in keys]),
+            tuple([(key, field, field + '_id') for key, field in self.refs.items() if keys is None or key in keys]),
+            tuple([(key, field) for key, field in self.timestamps_ms.items() if keys is None or key in keys]),
+            tuple([(key, field) for key, field in self.renames.items() if keys is None or key in keys]),
+        )
+
+    def normalize(self, response):
+        for marker, steps in self.shapes_steps:
+            if marker in response:
+                break
+        else:
+            steps = self.steps
+        unwraps, hooks, firsts, summaries, refs_items, timestamps_ms, renames = steps
+
+        # empty tables of shape are skipped without starting loops
+        refs = {}
+        pop = response.pop
+        if unwraps:
+            for key in unwraps:
+                if key in response:
+                    response.update(pop(key))
+        if hooks:
+            for key, substring, method in hooks:
+                if key in response and (substring is None or substring in response[key]):
+                    method(response, refs)
+        if firsts:
+            for key, item_key, field in firsts:
+                if key in response:
+                    response[field] = response[key][0][item_key]
+        if summaries:
+            for key, summary_key, field in summaries:
+                if key in response:
+                    response[field] = pop(key)[summary_key]
+        if refs_items:
+            for key, field, field_id in refs_items:
+                if key in response:
+                    refs[field], response[field_id] = pop(key).split(':')
+        if timestamps_ms:
+            for key, field in timestamps_ms:
+                if key in response:
+                    response[field] = pop(key) / 1000
+        if renames:
+            for key, field in renames:
+                if key in response:
+                    response[field] = pop(key)
+        return refs
+
+
+class DiscussionResponseNormalizer(ResponseNormalizer):
+
+    '''
+    Normalizer of discussions from responses of discussions.get, mediatopic.getByIds and stream.get
+    '''
+    unwraps = [
+        # discussions.get
+        'discussion',
+    ]
+    hooks = [
+        ('entities', 'media_topics', 'unwrap_media_topic'),
+        ('message', '{media_topic', 'set_media_topic_id'),
+    ]
+    firsts = {
+        # mediatopic.getByIds
+        'media': ('text', 'title'),
+    }
+    summaries = {
+        'like_summary': ('count', 'likes_count'),
+        'reshare_summary': ('count', 'reshares_count'),
+        'discussion_summary': ('comments_count', 'comments_count'),
+    }
+    refs = {
+        'author_ref': 'author',
+        'owner_ref': 'owner',
+    }
+    timestamps_ms = {
+        'created_ms': 'date',
+    }
+    renames = {
+        # in API owner is author
+        'owner_uid': 'author_id',
+        'like_count': 'likes_count',
+        'total_comments_count': 'comments_count',
+        'creation_date': 'date',
+    }
+    shapes = [
+        # discussions.get, media topic from entities is normalized by unwrap_media_topic()
+        ('discussion', ['discussion', 'entities', 'message', 'owner_uid', 'like_count', 'total_comments_count',
+                        'creation_date']),
+        # mediatopic.getByIds
+        ('created_ms', ['media', 'like_summary', 'reshare_summary', 'discussion_summary', 'author_ref', 'owner_ref',
+                        'created_ms']),
+        # stream.get
+        ('pattern', ['message', 'like_summary', 'reshare_summary', 'discussion_summary', 'author_ref', 'owner_ref']),
+    ]
+
+    def unwrap_media_topic(self, response, refs):
+        # Discussion.remote.fetch_one
+        entities = response['entities']
+        if len(entities['media_topics']) == 1:
+            media_topic = entities.pop('media_topics')[0]
+            refs.update(self.normalize(media_topic))
+            response.update(media_topic)
+            if 'polls' in entities:
+                response.update(entities.pop('polls')[0])
+                if 'vote_summary' in response:
+                    response['last_vote_date'] = response['vote_summary']['last_vote_date_ms'] / 1000
+                    response['votes_count'] = response['vote_summary']['count']
+
+    def set_media_topic_id(self, response, refs):
+        # response of stream.get has another format
+        m = MEDIA_TOPIC_RE.search(response['message'])
+        if m:
+            response['id'] = m.group(1) or ''
+            response['message'] = MEDIA_TOPIC_RE.sub('', response['message'])
+
+
+discussion_normalizer = DiscussionResponseNormalizer()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+PAGE_SIZE = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_PAGE_SIZE', 100)
+
+
+class CursorError(ValueError):
+    pass
+
+
+def encode_cursor(instance):
+    '''
+    Return cursor of position after `instance` as string "<microseconds of date>:<pk>"
+    '''
+    date = instance.date
+    if timezone.is_aware(date):
+        date = timezone.make_naive(date, timezone.utc)
+    delta = date - datetime(1970, 1, 1)
+    return '%d:%s' % ((delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds, instance.pk)
+
+
+def decode_cursor(cursor):
+    '''
+    Return tuple (date, pk) of cursor
+    '''
+    try:
+        microseconds, pk = cursor.split(':', 1)
+        date = datetime(1970, 1, 1) + timedelta(microseconds=int(microseconds))
+    except (AttributeError, ValueError, OverflowError):
+        raise CursorError("Wrong cursor %r" % cursor)
+    if settings.USE_TZ:
+        date = date.replace(tzinfo=timezone.utc)
+    return date, pk
+
+
+class TimelineQuerySet(QuerySet):
+
+    '''
+    QuerySet of models with field date and owner, ordered by (date, pk) and paginated by keyset.
+    Page after cursor is selected by condition on indexed date instead of OFFSET,
+    so deep pages cost the same as the first one
+    '''
+
+    def owned_by(self, owner):
+        return self.filter(owner_content_type=ContentType.objects.get_for_model(owner), owner_id=owner.pk)
+
+    def seek(self, cursor=None, reverse=True):
+        '''
+        Return queryset ordered by date and pk, latest first if `reverse`, starting after `cursor`
+        '''
+        queryset = self.order_by(*(['-date', '-pk'] if reverse else ['date', 'pk']))
+        if cursor:
+            date, pk = decode_cursor(cursor)
+            lookup = 'lt' if reverse else 'gt'
+            # range condition on date lets database seek index, pk breaks ties of equal dates
+            queryset = queryset.filter(**{'date__%se' % lookup: date}).filter(
+                Q(**{'date__%s' % lookup: date}) | Q(**{'pk__%s' % lookup: pk}))
+        return queryset
+
+    def page(self, cursor=None, size=PAGE_SIZE, reverse=True):
+        '''
+        Return tuple (list of `size` instances after `cursor`, cursor of the next page or None if it's the last one)
+        '''
+        instances = list(self.seek(cursor, reverse)[:size + 1])
+        if len(instances) > size:
+            return instances[:size], encode_cursor(instances[size - 1])
+        return instances, None
+
+
+class TimelineManager(models.Manager):
+
+    def get_queryset(self):
+        return TimelineQuerySet(self.model, using=self._db)
+
+    # Django < 1.6 calls get_query_set
+    get_query_set = get_queryset
+
+    def owned_by(self, *args, **kwargs):
+        return self.get_queryset().owned_by(*args, **kwargs)
+
+    def seek(self, *args, **kwargs):
+        return self.get_queryset().seek(*args, **kwargs)
+
+    def page(self, *args, **kwargs):
+        return self.get_queryset().page(*args, **kwargs)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:
+    # without flock bucket is shared only by threads of one process
+    fcntl = None
+
+# requests per second, rate is not limited if None
+API_RATE = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_API_RATE', None)
+API_BURST = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_API_BURST', API_RATE)
+API_RATE_FILE = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_API_RATE_FILE',
+                        os.path.join(tempfile.gettempdir(), 'odnoklassniki_discussions_api_rate'))
+
+
+class TokenBucket(object):
+
+    '''
+    Token bucket refilled with `rate` tokens per second up to `burst` tokens. State of bucket is stored
+    in the file locked by flock, so bucket is shared by all threads and local processes using the same file
+    '''
+
+    def __init__(self, rate, burst=None, path=API_RATE_FILE):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.path = path
+        self.lock = threading.Lock()
+
+    def take(self, tokens=1):
+        '''
+        Refill bucket and take `tokens` if they are available.
+        Return tuple (available tokens, seconds to wait for missing tokens)
+        '''
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                now = time.time()
+                try:
+                    available, updated = map(float, os.read(fd, 100).split())
+                except ValueError:
+                    available, updated = self.burst, now
+                available = min(self.burst, available + max(now - updated, 0) * self.rate)
+
+                wait = 0
+                if available >= tokens:
+                    available -= tokens
+                else:
+                    wait = (tokens - available) / self.rate
+
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, '%f %f' % (available, now))
+            finally:
+                # lock is released with closing of file
+                os.close(fd)
+        return available, wait
+
+    def acquire(self, tokens=1):
+        '''
+        Wait for `tokens` and take them. Return number of seconds of waiting
+        '''
+        waited = 0
+        while True:
+            available, wait = self.take(tokens)
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def utilization(self):
+        '''
+        Return part of the bucket used at the moment, 1 means requests are limited by rate
+        '''
+        available, wait = self.take(0)
+        return 1 - available / self.burst
+
+
+rate_limiter = TokenBucket(API_RATE, API_BURST) if API_RATE else None
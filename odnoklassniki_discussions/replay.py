@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+import calendar
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import odnoklassniki_api.models
+
+from .cache import get_key
+
+FAKE_DATE = datetime(2014, 4, 11, 12, 0)
+FAKE_USER_ID = 10 ** 12
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class CassetteError(Exception):
+    pass
+
+
+def copy_response(response):
+    # responses are changed while parsing, so recorded ones are never returned as is
+    return json.loads(json.dumps(response))
+
+
+@contextmanager
+def replace_api(api_call):
+    '''
+    Replace function calling API by callable `api_call(method, **params)` for all remote managers
+    '''
+    original = odnoklassniki_api.models.api_call
+    odnoklassniki_api.models.api_call = api_call
+    try:
+        yield api_call
+    finally:
+        odnoklassniki_api.models.api_call = original
+
+
+class Cassette(object):
+
+    '''
+    Recorded API calls stored in JSON file as list of interactions {"method": ..., "params": ..., "response": ...}.
+    Responses of the same call are replayed in order of recording, the last one is repeated.
+    If `api_call` is specified, calls missed in cassette are passed to it and recorded
+    '''
+
+    def __init__(self, path=None, api_call=None):
+        self.path = path
+        self.api_call = api_call
+        self.interactions = []
+        self.positions = {}
+        self.changed = False
+        if path and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as f:
+            self.interactions = json.load(f)
+        self.positions = {}
+        self.changed = False
+
+    def save(self, path=None):
+        with open(path or self.path, 'w') as f:
+            json.dump(self.interactions, f, indent=1, sort_keys=True)
+        self.changed = False
+
+    def append(self, method, params, response):
+        self.interactions.append({'method': method, 'params': params, 'response': copy_response(response)})
+        self.changed = True
+
+    def record(self, api_call):
+        '''
+        Return callable, that calls `api_call` and records its responses
+        '''
+        def wrapper(method, **params):
+            response = api_call(method, **params)
+            self.append(method, params, response)
+            return response
+        return wrapper
+
+    def play(self, method, **params):
+        key = get_key(method, params)
+        responses = [interaction['response'] for interaction in self.interactions
+                     if get_key(interaction['method'], interaction['params']) == key]
+        if not responses:
+            if self.api_call is None:
+                raise CassetteError("Call of method %s with params %s is not recorded" % (method, params))
+            response = self.api_call(method, **params)
+            self.append(method, params, response)
+            responses = [response]
+
+        position = self.positions.get(key, 0)
+        self.positions[key] = position + 1
+        return copy_response(responses[min(position, len(responses) - 1)])
+
+    __call__ = play
+
+
+class FakeApi(object):
+
+    '''
+    Local stand-in of API generating paginated discussions of groups, comments and likes of discussions.
+    Each group has `discussions` discussions, each discussion has `comments` comments and `likes` likes
+    of users from pool of `users` users. Each call sleeps `latency` seconds.
+    Polls are not generated, PollRemoteManager has no working parser of them yet
+    '''
+
+    def __init__(self, discussions=10, comments=20, likes=10, users=100, latency=0):
+        if discussions > 1000:
+            raise ValueError("Fake API generates not more than 1000 discussions of group")
+        self.discussions = discussions
+        self.comments = comments
+        self.likes = likes
+        self.users = users
+        self.latency = latency
+        self.calls = 0
+        self.methods = {
+            'stream.get': self.get_stream,
+            'mediatopic.getByIds': self.get_mediatopics,
+            'discussions.getComments': self.get_comments,
+            'discussions.getDiscussionLikes': self.get_likes,
+            'discussions.getCommentLikes': self.get_likes,
+            'users.getInfo': self.get_users,
+            'group.getInfo': self.get_groups,
+        }
+
+    def __call__(self, method, **params):
+        if method not in self.methods:
+            raise CassetteError("Method %s is not supported by fake API" % method)
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.methods[method](**params)
+
+    def get_page(self, total, count, anchor):
+        offset = int(anchor or 0)
+        return range(offset, min(offset + int(count), total)), (str(offset + int(count))
+                                                                 if offset + int(count) < total else None)
+
+    def get_discussion_id(self, group_id, number):
+        return group_id * 1000 + number
+
+    def get_user(self, id):
+        return {'uid': str(id), 'first_name': 'User', 'last_name': str(id), 'name': 'User %s' % id}
+
+    def get_discussion(self, group_id, number):
+        return {
+            'author_ref': 'group:%d' % group_id,
+            'owner_ref': 'group:%d' % group_id,
+            'like_summary': {'count': self.likes, 'self': False},
+            'discussion_summary': {'comments_count': self.comments},
+        }
+
+    def get_stream(self, gid, count=100, anchor=None, **params):
+        numbers, anchor = self.get_page(self.discussions, count, anchor)
+        feeds = []
+        for number in numbers:
+            feed = self.get_discussion(int(gid), number)
+            feed['pattern'] = 'POST'
+            feed['message'] = '{media_topic:%d}' % self.get_discussion_id(int(gid), number)
+            feed['date'] = (FAKE_DATE - timedelta(hours=number)).strftime(DATE_FORMAT)
+            feeds.append(feed)
+
+        response = {'feeds': feeds}
+        if anchor:
+            response['anchor'] = anchor
+        return response
+
+    def get_mediatopics(self, topic_ids, **params):
+        topics = []
+        for id in map(int, topic_ids.split(',')):
+            group_id, number = divmod(id, 1000)
+            topic = self.get_discussion(group_id, number)
+            topic['id'] = str(id)
+            topic['created_ms'] = calendar.timegm((FAKE_DATE - timedelta(hours=number)).timetuple()) * 1000
+            topic['media'] = [{'type': 'text', 'text': 'Discussion %d' % id}]
+            topics.append(topic)
+        return {'media_topics': topics}
+
+    def get_comments(self, discussionId, count=100, anchor=None, **params):
+        # like API pages start from the newest comment, so comments added later are on the first pages
+        numbers, anchor = self.get_page(self.comments, count, anchor)
+        comments = []
+        for number in [self.comments - 1 - number for number in numbers]:
+            comment = {
+                'id': '%s-%d' % (discussionId, number),
+                'author_id': str(FAKE_USER_ID + number % self.users),
+                'text': 'Comment %d' % number,
+                'date': (FAKE_DATE + timedelta(minutes=number)).strftime(DATE_FORMAT),
+                'type': 'ACTIVE_MESSAGE',
+                'like_count': 0,
+            }
+            if number and number % 3 == 0:
+                comment['reply_to_comment_id'] = '%s-%d' % (discussionId, number - 1)
+                comment['reply_to_id'] = str(FAKE_USER_ID + (number - 1) % self.users)
+            comments.append(comment)
+
+        response = {'comments': comments, 'has_more': anchor is not None}
+        if anchor:
+            response['anchor'] = anchor
+        return response
+
+    def get_likes(self, count=100, anchor=None, **params):
+        numbers, anchor = self.get_page(self.likes, count, anchor)
+        response = {'users': [self.get_user(FAKE_USER_ID + number % self.users) for number in numbers]}
+        if anchor:
+            response['anchor'] = anchor
+        return response
+
+    def get_users(self, uids, **params):
+        return [self.get_user(id) for id in uids.split(',')]
+
+    def get_groups(self, uids, **params):
+        return [{'uid': id, 'name': 'Group %s' % id} for id in uids.split(',')]
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime
+
+from django.conf import settings
+from django.db import IntegrityError, connection
+from django.db.backends.util import typecast_timestamp
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+from odnoklassniki_api.decorators import atomic, list_chunks_iterator
+
+# update daily engagement of owners while saving discussions and comments, it's off by default,
+# rows of stored ones are recomputed by command rebuild_odnoklassniki_rollups
+ROLLUPS = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_ROLLUPS', False)
+
+KEY_FIELDS = ('owner_content_type_id', 'owner_id', 'date', 'object_type')
+
+
+def get_day(value):
+    '''
+    Return day of datetime `value` in UTC, the same as day truncated by DB
+    '''
+    if timezone.is_aware(value):
+        value = value.astimezone(timezone.utc)
+    return value.date()
+
+
+class EngagementRollup(object):
+
+    '''
+    Incremental updates of DailyEngagement rows keyed by owner, day and type of discussion.
+    Changes are written immediately or at the end of the outer batch() by one query for each key.
+    Updates are made only if `enabled` (setting ODNOKLASSNIKI_DISCUSSIONS_ROLLUPS, off by default),
+    rebuild() recomputes rows by stored discussions and comments
+    '''
+    fields = ('discussions_count', 'comments_count', 'likes_count', 'reshares_count')
+
+    def __init__(self, enabled=ROLLUPS):
+        self.enabled = enabled
+        self.local = threading.local()
+
+    @contextmanager
+    def batch(self):
+        if getattr(self.local, 'changes', None) is not None:
+            # nested batch is written by the outer one
+            yield
+            return
+
+        self.local.changes = defaultdict(lambda: defaultdict(int))
+        try:
+            yield
+            changes = self.local.changes
+        finally:
+            self.local.changes = None
+        self.write(changes)
+
+    def add(self, owner_content_type_id, owner_id, date, object_type, **values):
+        if not self.enabled or not owner_content_type_id or not owner_id or date is None:
+            return
+
+        key = (owner_content_type_id, int(owner_id), get_day(date), object_type or '')
+        changes = getattr(self.local, 'changes', None)
+        if changes is None:
+            return self.write({key: values})
+        for field, value in values.items():
+            changes[key][field] += value
+
+    def add_discussion(self, discussion, stored_discussion=None):
+        '''
+        Add saved discussion, `stored_discussion` is the previous version of it or None if it's inserted
+        '''
+        with self.batch():
+            if stored_discussion is not None:
+                self.add(*[getattr(stored_discussion, field) for field in KEY_FIELDS[:2]] +
+                         [stored_discussion.date, stored_discussion.object_type], discussions_count=-1,
+                         likes_count=-stored_discussion.likes_count, reshares_count=-stored_discussion.reshares_count)
+            self.add(discussion.owner_content_type_id, discussion.owner_id, discussion.date, discussion.object_type,
+                     discussions_count=1, likes_count=discussion.likes_count, reshares_count=discussion.reshares_count)
+
+    def add_comments(self, comments):
+        '''
+        Add inserted comments with loaded discussions
+        '''
+        with self.batch():
+            for comment in comments:
+                self.add(comment.owner_content_type_id, comment.owner_id, comment.date,
+                         comment.discussion.object_type, comments_count=1)
+
+    def write(self, changes):
+        from .models import DailyEngagement
+
+        for key, values in changes.items():
+            values = dict([(field, value) for field, value in values.items() if value])
+            if not values:
+                continue
+
+            lookup = dict(zip(KEY_FIELDS, key))
+            updates = dict([(field, F(field) + value) for field, value in values.items()])
+            if DailyEngagement.objects.filter(**lookup).update(**updates):
+                continue
+            try:
+                with atomic():
+                    DailyEngagement.objects.create(**dict(lookup, **values))
+            except IntegrityError:
+                # row was inserted by another process after update
+                DailyEngagement.objects.filter(**lookup).update(**updates)
+
+    @atomic
+    def rebuild(self, owner_content_type=None, owner_ids=None):
+        '''
+        Recompute DailyEngagement rows of owners with `owner_ids` or of all owners by GROUP BY queries
+        over discussions and comments. Return number of rows
+        '''
+        from .models import BULK_BATCH_SIZE, Comment, DailyEngagement, Discussion
+
+        lookup = {}
+        if owner_content_type is not None:
+            lookup['owner_content_type'] = owner_content_type
+        if owner_ids is not None:
+            lookup['owner_id__in'] = owner_ids
+
+        rows = defaultdict(dict)
+        for key, values in self.group_by_day(Discussion.objects.filter(**lookup), 'object_type',
+                                             discussions_count=Count('pk'), likes_count=Sum('likes_count'),
+                                             reshares_count=Sum('reshares_count')):
+            rows[key].update(values)
+        for key, values in self.group_by_day(Comment.objects.filter(**lookup), 'discussion__object_type',
+                                             comments_count=Count('pk')):
+            rows[key].update(values)
+
+        DailyEngagement.objects.filter(**lookup).delete()
+        instances = [DailyEngagement(**dict(zip(KEY_FIELDS, key), **values)) for key, values in rows.items()]
+        for chunk in list_chunks_iterator(instances, BULK_BATCH_SIZE):
+            DailyEngagement.objects.bulk_create(chunk)
+        return len(instances)
+
+    def group_by_day(self, queryset, type_field, **aggregates):
+        '''
+        Yield pairs (key, aggregated values) of queryset grouped by owner, day of field date and `type_field`
+        '''
+        qn = connection.ops.quote_name
+        # dates are stored in UTC, so day is truncated without conversion to the current time zone
+        sql = connection.ops.date_trunc_sql('day', '%s.%s' % (qn(queryset.model._meta.db_table), qn('date')))
+
+        rows = queryset.extra(select={'day': sql}).order_by() \
+            .values('owner_content_type', 'owner_id', 'day', type_field).annotate(**aggregates)
+        for row in rows:
+            day = row.pop('day')
+            # backends return truncated day as string, date or datetime
+            if not isinstance(day, date):
+                day = typecast_timestamp(str(day))
+            if isinstance(day, datetime):
+                day = day.date()
+            key = (row.pop('owner_content_type'), row.pop('owner_id'), day, row.pop(type_field) or '')
+            yield key, dict([(field, value or 0) for field, value in row.items()])
+
+
+engagement_rollup = EngagementRollup()
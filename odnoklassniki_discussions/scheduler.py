@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import calendar
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+REFRESH_AGE_PART = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_REFRESH_AGE_PART', 0.25)
+REFRESH_INTERVAL_MIN = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_REFRESH_INTERVAL_MIN', timedelta(minutes=10))
+REFRESH_INTERVAL_MAX = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_REFRESH_INTERVAL_MAX', timedelta(days=30))
+REFRESH_SLOT = getattr(settings, 'ODNOKLASSNIKI_DISCUSSIONS_REFRESH_SLOT', timedelta(minutes=10))
+
+
+def make_aware(value):
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return value
+
+
+class RefreshScheduler(object):
+
+    '''
+    Scheduler of refreshing discussions. Interval to the next refresh is the part `age_part` of time
+    since the last activity of discussion, it's divided by 1 + number of changes of counters since the last refresh.
+    Interval is limited by `interval_min` and `interval_max`, time of refresh is rounded up to `slot`,
+    so discussions scheduled together can be updated by one query
+    '''
+    fields = ('comments_count', 'likes_count', 'reshares_count')
+
+    def __init__(self, age_part=REFRESH_AGE_PART, interval_min=REFRESH_INTERVAL_MIN,
+                 interval_max=REFRESH_INTERVAL_MAX, slot=REFRESH_SLOT):
+        self.age_part = age_part
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+        self.slot = slot
+
+    def get_changes(self, values, old_values):
+        return sum([abs((value or 0) - (old_value or 0)) for value, old_value in zip(values, old_values)])
+
+    def get_interval(self, activity_date, changes=0, now=None):
+        if activity_date is None:
+            return self.interval_max
+
+        age = make_aware(now or timezone.now()) - make_aware(activity_date)
+        interval = timedelta(seconds=age.total_seconds() * self.age_part / (1 + changes))
+        return min(max(interval, self.interval_min), self.interval_max)
+
+    def get_refresh_at(self, activity_date, changes=0, now=None):
+        now = make_aware(now or timezone.now())
+        seconds = calendar.timegm((now + self.get_interval(activity_date, changes, now)).utctimetuple())
+        slot = int(self.slot.total_seconds())
+        seconds = (seconds + slot - 1) // slot * slot
+        return datetime.utcfromtimestamp(seconds).replace(tzinfo=timezone.utc)
+
+    def schedule(self, instance, old_instance=None):
+        '''
+        Set time of the next refresh of discussion
+        '''
+        changes = 0
+        if old_instance is not None:
+            changes = self.get_changes([getattr(instance, field) for field in self.fields],
+                                       [getattr(old_instance, field) for field in self.fields])
+        instance.refresh_at = self.get_refresh_at(instance.last_activity_date or instance.date, changes)
+
+
+refresh_scheduler = RefreshScheduler()
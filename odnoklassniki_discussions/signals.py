@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+from django.dispatch import Signal
+
+# sent by ApiMetrics after processing of each page of API response, sender is model of remote manager
+api_page_processed = Signal(providing_args=['method', 'seconds', 'size', 'items', 'queries', 'processing_seconds'])
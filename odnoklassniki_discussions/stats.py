@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import defaultdict
+
+
+class Counters(object):
+
+    '''
+    Thread-safe named counters
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = defaultdict(int)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.values[name] += value
+
+    def reset(self):
+        with self.lock:
+            self.values = defaultdict(int)
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+
+counters = Counters()
@@ -1,14 +1,38 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from StringIO import StringIO
 
+import odnoklassniki_api.models as api_models
 import simplejson as json
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
 from django.test import TestCase
 from django.utils import timezone
 from odnoklassniki_groups.models import Group
 from odnoklassniki_api.models import OdnoklassnikiContentError
 
+from . import models
+from .cache import ResponseCache
+from .executor import as_completed
 from .factories import CommentFactory, DiscussionFactory, GroupFactory, UserFactory
-from .models import Comment, Discussion, User
+from .metrics import ApiMetrics
+from .models import (Comment, CrawlCheckpoint, DailyEngagement, Discussion, User, bulk_create_missing,
+                     get_or_create_users, ref_resolver)
+from .normalizers import discussion_normalizer
+from .pagination import CursorError
+from .ratelimit import TokenBucket
+from .replay import FAKE_USER_ID, Cassette, CassetteError, FakeApi, replace_api
+from .rollups import engagement_rollup
+from .scheduler import RefreshScheduler
+from .signals import api_page_processed
 
 # GROUP_ID = 47241470410797
 # GROUP_NAME = u'Кока-Кола'
@@ -36,9 +60,116 @@ GROUP4_DISCUSSION_WITH_GROUP_COMMENTS_ID = 62520921350357
 
 GROUP_DISCUSSION_GHOST = 62671523553304
 
+# API calls replayed by tests of queries budgets, calls missed in cassette fail tests.
+# To record missed calls from FakeApi run tests with environment variable RECORD_CASSETTES=1
+CASSETTE_PATH = os.path.join(os.path.dirname(__file__), 'cassettes', 'group.json')
+CASSETTE_RECORD = bool(os.environ.get('RECORD_CASSETTES'))
+CASSETTE_FAKE_API = {'discussions': 4, 'comments': 7, 'likes': 5, 'users': 5}
+CASSETTE_COUNT = 3
+
+# maximum of DB queries per saved discussion, comment or like of each fetching path
+QUERIES_BUDGETS = {
+    'fetch_group': 7.25,
+    'fetch_group_resumable': 7.25,
+    'fetch_comments': 6.5,
+    'fetch_comments_bulk': 2.6,
+    'fetch_comments_streaming': 4.1,
+    'fetch_comments_async': 1.7,
+    'fetch_likes': 2.45,
+    'fetch_likes_async': 2.1,
+}
+QUERIES_REPORT = {}
+
+
+@contextmanager
+def capture_queries():
+    '''
+    Collect queries executed inside the block to the list by debug cursor, CaptureQueriesContext needs Django 1.6
+    '''
+    queries = []
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    start = len(connection.queries)
+    try:
+        yield queries
+    finally:
+        queries.extend(connection.queries[start:])
+        connection.use_debug_cursor = use_debug_cursor
+
 
 class OdnoklassnikiDiscussionsTest(TestCase):
 
+    @classmethod
+    def tearDownClass(cls):
+        super(OdnoklassnikiDiscussionsTest, cls).tearDownClass()
+        if QUERIES_REPORT:
+            sys.stderr.write('\nQueries per item of fetching paths:\n')
+            for path, (queries, items) in sorted(QUERIES_REPORT.items()):
+                sys.stderr.write('%-25s %5d queries %5d items %6.2f queries/item, budget %s\n' % (
+                    path, queries, items, float(queries) / items, QUERIES_BUDGETS[path]))
+
+    def replay(self, fetch):
+        '''
+        Run fetch() with API calls replayed from cassette, cassette is changed only if CASSETTE_RECORD is True
+        '''
+        cassette = Cassette(CASSETTE_PATH, api_call=FakeApi(**CASSETTE_FAKE_API) if CASSETTE_RECORD else None)
+        try:
+            with replace_api(cassette):
+                return fetch()
+        finally:
+            if cassette.changed:
+                cassette.save()
+
+    def assertQueriesBudget(self, path, fetch):
+        '''
+        Check number of DB queries per item saved by fetch() with API calls replayed from cassette
+        '''
+        with capture_queries() as queries:
+            items = self.replay(fetch)
+        queries = len(queries)
+        QUERIES_REPORT[path] = (queries, items)
+
+        self.assertGreater(items, 0)
+        self.assertLessEqual(float(queries) / items, QUERIES_BUDGETS[path],
+                             "%s: %d queries for %d items, %.2f queries/item is more than budget %s" % (
+                                 path, queries, items, float(queries) / items, QUERIES_BUDGETS[path]))
+
+    def fetch_replayed_group(self):
+        group = GroupFactory(id=GROUP1_ID)
+        return self.replay(lambda: list(Discussion.remote.fetch_group(group, all=True, count=CASSETTE_COUNT)))
+
+    def test_queries_budget_fetch_group(self):
+
+        group = GroupFactory(id=GROUP1_ID)
+        self.assertQueriesBudget('fetch_group', lambda: Discussion.remote.fetch_group(
+            group, all=True, count=CASSETTE_COUNT).count())
+        self.assertQueriesBudget('fetch_group_resumable', lambda: Discussion.remote.fetch_group(
+            group, all=True, count=CASSETTE_COUNT, resumable=True).count())
+
+    def test_queries_budget_fetch_comments(self):
+
+        discussions = self.fetch_replayed_group()
+        for path, kwargs in [('fetch_comments', {}), ('fetch_comments_bulk', {'bulk': True}),
+                             ('fetch_comments_streaming', {'streaming': True})]:
+            Comment.objects.all().delete()
+            self.assertQueriesBudget(path, lambda: sum([discussion.fetch_comments(
+                all=True, count=CASSETTE_COUNT, **kwargs).count() for discussion in discussions]))
+
+        Comment.objects.all().delete()
+        self.assertQueriesBudget('fetch_comments_async', lambda: sum([future.result().count() for future in [
+            discussion.fetch_comments_async(all=True, count=CASSETTE_COUNT) for discussion in discussions]]))
+
+    def test_queries_budget_fetch_likes(self):
+
+        discussions = self.fetch_replayed_group()
+        self.assertQueriesBudget('fetch_likes', lambda: sum([discussion.fetch_likes(
+            all=True, count=CASSETTE_COUNT).count() for discussion in discussions]))
+
+        User.objects.filter(pk__gte=FAKE_USER_ID).delete()
+        Discussion.like_users.through.objects.all().delete()
+        self.assertQueriesBudget('fetch_likes_async', lambda: sum([future.result().count() for future in [
+            discussion.fetch_likes_async(count=CASSETTE_COUNT) for discussion in discussions]]))
+
     def test_fetch_group_discussions_empty_result(self):
 
         group = GroupFactory(id=57110225354790)
@@ -128,13 +259,16 @@ class OdnoklassnikiDiscussionsTest(TestCase):
         discussion = DiscussionFactory(id=GROUP_DISCUSSION_WITH_MANY_COMMENTS1_ID, object_type='GROUP_TOPIC')
 
         self.assertEqual(Comment.objects.count(), 0)
+        comments_count = discussion.comments_count
 
         comments = discussion.fetch_comments()
 
         self.assertEqual(comments.count(), 100)
-        self.assertEqual(comments.count(), discussion.comments_count)
         self.assertEqual(comments.count(), Comment.objects.count())
         self.assertEqual(comments.count(), discussion.comments.count())
+        # fetching of one page keeps counter of discussion
+        self.assertEqual(discussion.comments_count, comments_count)
+        self.assertEqual(Discussion.objects.get(pk=discussion.pk).comments_count, comments_count)
 
         # test `after` argument
         after = datetime(2014, 5, 1, 8, 34, 8, tzinfo=timezone.utc)
@@ -147,6 +281,12 @@ class OdnoklassnikiDiscussionsTest(TestCase):
         comments_before = discussion.fetch_comments(all=True, after=after, before=before)
         self.assertLess(comments_before.count(), comments_after.count())
         self.assertEqual(comments_before.filter(date__lt=after).filter(date__gt=before).count(), 0)
+        self.assertEqual(discussion.comments_count, comments_count)
+
+        # fetching of all comments sets counter to number of them
+        comments = discussion.fetch_comments(all=True)
+        self.assertEqual(comments.count(), discussion.comments_count)
+        self.assertEqual(comments.count(), discussion.comments.count())
 
     def test_fetch_discussion_comments_all(self):
 
@@ -331,12 +471,15 @@ class OdnoklassnikiDiscussionsTest(TestCase):
             "reply_to_id": "134519031824",
             "text": "наверное и я так буду делать!",
             "type": "ACTIVE_MESSAGE"}'''
-        comment = CommentFactory(id='MTM5NzIwNjMzNjI2MTotODE0MzoxMzk3MjA2MzM2MjYxOjYyNTAzOTI5NjYyMzIwOjE=')
-        author = UserFactory(id=134519031824)
         discussion = DiscussionFactory()
+        comment = CommentFactory(id='MTM5NzIwNjMzNjI2MTotODE0MzoxMzk3MjA2MzM2MjYxOjYyNTAzOTI5NjYyMzIwOjE=',
+                                 discussion=discussion)
+        author = UserFactory(id=134519031824)
         instance = Comment(discussion=discussion)
         instance.parse(json.loads(response))
         instance.save()
+        Comment.remote.link_reply_to_comments(discussion)
+        instance = Comment.objects.get(pk=instance.pk)
 
         self.assertEqual(instance.id, 'MTM5NzIwNjM4MjQ3MTotMTU5NDE6MTM5NzIwNjM4MjQ3MTo2MjUwMzkyOTY2MjMyMDox')
         self.assertEqual(instance.object_type, 'ACTIVE_MESSAGE')
@@ -348,3 +491,872 @@ class OdnoklassnikiDiscussionsTest(TestCase):
         self.assertEqual(instance.reply_to_author, User.objects.get(pk=134519031824))
         self.assertIsInstance(instance.date, datetime)
         self.assertIsInstance(instance.attrs, dict)
+
+    def test_bulk_create_comments(self):
+
+        group = GroupFactory(id=GROUP4_ID)
+        discussion = DiscussionFactory(owner=group, object_type='GROUP_TOPIC')
+        users = [UserFactory() for i in range(3)]
+        response = {'comments': [
+            {'id': 'c3', 'author_id': users[2].id, 'date': '2014-04-11 12:53:03', 'like_count': 3,
+             'reply_to_comment_id': 'c1', 'reply_to_id': users[0].id, 'text': 'reply', 'type': 'ACTIVE_MESSAGE'},
+            {'id': 'c2', 'author_id': group.id, 'author_type': 'GROUP', 'author_name': group.name,
+             'date': '2014-04-11 12:53:02', 'like_count': 2, 'text': 'group', 'type': 'ACTIVE_MESSAGE'},
+            {'id': 'c1', 'author_id': users[0].id, 'date': '2014-04-11 12:53:01', 'like_count': 1,
+             'reply_to_comment_id': 'unknown', 'text': 'first', 'type': 'ACTIVE_MESSAGE'},
+        ]}
+
+        instances = Comment.remote.parse_response(response, {'discussion_id': discussion.id})
+        comments = Comment.remote.bulk_create_from_instances_list(instances)
+        Comment.remote.link_reply_to_comments(discussion)
+
+        self.assertEqual(comments.count(), 3)
+        self.assertEqual(Comment.objects.count(), 3)
+        self.assertEqual(discussion.comments.filter(owner_id=group.id).count(), 3)
+        self.assertEqual(Comment.objects.get(pk='c1').author, users[0])
+        self.assertEqual(Comment.objects.get(pk='c1').reply_to_comment, None)
+        self.assertEqual(Comment.objects.get(pk='c2').author, group)
+        self.assertEqual(Comment.objects.get(pk='c3').reply_to_comment, Comment.objects.get(pk='c1'))
+        self.assertEqual(Comment.objects.get(pk='c3').reply_to_author, users[0])
+
+        # existing comments are updated, not duplicated
+        response['comments'][0]['like_count'] = 30
+        instances = Comment.remote.parse_response(response, {'discussion_id': discussion.id})
+        comments = Comment.remote.bulk_create_from_instances_list(instances)
+
+        self.assertEqual(comments.count(), 3)
+        self.assertEqual(Comment.objects.count(), 3)
+        self.assertEqual(Comment.objects.get(pk='c3').likes_count, 30)
+        self.assertEqual(Comment.objects.get(pk='c3').reply_to_comment_id, 'c1')
+
+        # unchanged comments are updated by one query
+        response['comments'][0]['like_count'] = 31
+        instances = Comment.remote.parse_response(response, {'discussion_id': discussion.id,
+                                                             'fetched': timezone.now()})
+        with capture_queries() as queries:
+            Comment.remote.bulk_save(instances)
+        self.assertEqual(len([query for query in queries if 'UPDATE' in query['sql']]), 2)
+        self.assertEqual(Comment.objects.get(pk='c3').likes_count, 31)
+        self.assertEqual(Comment.objects.filter(fetched=instances[0].fetched).count(), 3)
+
+    def test_comments_authors_batch_resolution(self):
+
+        discussion = DiscussionFactory(object_type='GROUP_TOPIC')
+        users = [UserFactory() for i in range(3)]
+        response = {'comments': [{'id': 'c%d' % i, 'author_id': users[i % 3].id + (1000 if i % 2 else 0),
+                                  'date': '2014-04-11 12:53:%02d' % i, 'text': 'text', 'type': 'ACTIVE_MESSAGE'}
+                                 for i in range(10)]}
+        instances = Comment.remote.parse_response(response, {'discussion_id': discussion.id})
+
+        fetched_ids = []
+
+        def fetch(ids):
+            fetched_ids.append(sorted(ids))
+            return [UserFactory(id=id) for id in ids]
+
+        User.remote.fetch = fetch
+        try:
+            Comment.remote.set_authors(instances)
+        finally:
+            del User.remote.fetch
+
+        # one remote request for all missed authors
+        self.assertEqual(fetched_ids, [sorted(set([users[i % 3].id + 1000 for i in range(1, 10, 2)]))])
+        self.assertEqual([instance.author.id for instance in instances], [instance.author_id for instance in instances])
+
+    def test_link_reply_to_comments(self):
+
+        discussion = DiscussionFactory(object_type='GROUP_TOPIC')
+        user = UserFactory()
+        reply = {'id': 'c2', 'author_id': user.id, 'date': '2014-04-11 12:53:02', 'reply_to_comment_id': 'c1',
+                 'reply_to_id': user.id, 'text': 'reply', 'type': 'ACTIVE_MESSAGE'}
+        parent = {'id': 'c1', 'author_id': user.id, 'date': '2014-04-11 12:53:01', 'text': 'parent',
+                  'type': 'ACTIVE_MESSAGE'}
+
+        # reply is saved before parent
+        Comment.remote.bulk_create_from_instances_list(
+            Comment.remote.parse_response({'comments': [reply]}, {'discussion_id': discussion.id}))
+        self.assertEqual(Comment.remote.link_reply_to_comments(discussion), 0)
+        self.assertEqual(Comment.objects.get(pk='c2').reply_to_comment, None)
+        self.assertEqual(Comment.objects.get(pk='c2').reply_to_comment_remote_id, 'c1')
+
+        Comment.remote.bulk_create_from_instances_list(
+            Comment.remote.parse_response({'comments': [parent]}, {'discussion_id': discussion.id}))
+        with self.assertNumQueries(2):
+            self.assertEqual(Comment.remote.link_reply_to_comments(discussion), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(Comment.remote.link_reply_to_comments(discussion), 0)
+        self.assertEqual(Comment.objects.get(pk='c2').reply_to_comment, Comment.objects.get(pk='c1'))
+
+        # saved batch links its replies to stored parents and stored replies to its comments
+        reply_new = dict(reply, id='c4', reply_to_comment_id='c3')
+        reply_stored = dict(reply, id='c5', reply_to_comment_id='c1')
+        parent_new = dict(parent, id='c3')
+        Comment.remote.save_discussion_comments(discussion, Comment.remote.parse_response(
+            {'comments': [reply_new, reply_stored]}, {'discussion_id': discussion.id}))
+        self.assertEqual(Comment.objects.get(pk='c4').reply_to_comment, None)
+        self.assertEqual(Comment.objects.get(pk='c5').reply_to_comment_id, 'c1')
+        Comment.remote.save_discussion_comments(discussion, Comment.remote.parse_response(
+            {'comments': [parent_new]}, {'discussion_id': discussion.id}))
+        self.assertEqual(Comment.objects.get(pk='c4').reply_to_comment_id, 'c3')
+        self.assertEqual(Comment.remote.link_reply_to_comments(discussion, ['c3']), 0)
+
+    def test_fetch_discussion_comments_incremental(self):
+
+        # counter keeps total number of 6 comments from API on incremental fetching
+        discussion = DiscussionFactory(object_type='GROUP_TOPIC', comments_count=6)
+        user = UserFactory()
+        resources = [{'id': 'c%d' % i, 'author_id': user.id, 'date': '2014-04-11 12:53:0%d' % i, 'text': 'text',
+                      'type': 'ACTIVE_MESSAGE'} for i in range(6)]
+        # c2 and c3 have the same date, c3 is new
+        resources[3]['date'] = resources[2]['date']
+        Comment.remote.bulk_create_from_instances_list(
+            Comment.remote.parse_response({'comments': resources[:3]}, {'discussion_id': discussion.id}))
+
+        anchors = []
+
+        def api_call(method='get', **kwargs):
+            # pages from the newest comments: [c5, c4], [c3, c2], [c1, c0]
+            anchors.append(kwargs.get('anchor'))
+            page = int(kwargs.get('anchor', 0))
+            comments = resources[4 - page * 2:6 - page * 2][::-1]
+            return {'has_more': page < 2, 'anchor': str(page + 1), 'comments': [dict(c) for c in comments]}
+
+        Comment.remote.api_call = api_call
+        try:
+            comments = Comment.remote.fetch(discussion=discussion, incremental=True)
+            self.assertEqual(anchors, [None, '1'])
+            self.assertEqual(sorted(comments.values_list('pk', flat=True)), ['c3', 'c4', 'c5'])
+            self.assertEqual(Discussion.objects.get(pk=discussion.pk).comments_count, 6)
+
+            anchors = []
+            comments = Comment.remote.fetch(discussion=discussion, incremental=True, bulk=True)
+            self.assertEqual(anchors, [None])
+            self.assertEqual(comments.count(), 0)
+        finally:
+            del Comment.remote.api_call
+
+    def test_fetch_discussion_comments_incremental_replayed(self):
+
+        group = GroupFactory(id=GROUP4_ID)
+        discussion = DiscussionFactory(owner=group, author=group, object_type='GROUP_TOPIC')
+
+        with replace_api(FakeApi(comments=5, users=5)):
+            discussion.fetch_comments(all=True)
+        self.assertEqual(discussion.comments.count(), 5)
+
+        # 3 comments are added, pages of 2 comments from the newest one: [7, 6], [5, 4], ...
+        api = FakeApi(comments=8, users=5)
+        with replace_api(api):
+            comments = discussion.fetch_comments(incremental=True, count=2)
+        self.assertEqual(api.calls, 2)
+        self.assertEqual(sorted(comments.values_list('pk', flat=True)),
+                         ['%s-%d' % (discussion.pk, number) for number in [5, 6, 7]])
+        self.assertEqual(discussion.comments.count(), 8)
+        # reply of the new comment 6 to the stored comment 5 is linked
+        self.assertEqual(Comment.objects.get(pk='%s-6' % discussion.pk).reply_to_comment_id, '%s-5' % discussion.pk)
+
+    def test_fetch_group_discussions_resumable(self):
+
+        group = GroupFactory(id=GROUP4_ID)
+        requests = []
+
+        def api_call(method='get', **kwargs):
+            # 3 pages by 2 discussions and the last empty page
+            page = int(kwargs.get('anchor', 0))
+            requests.append(page)
+            if page == 1 and len(requests) == 2:
+                raise OdnoklassnikiContentError()
+            if page == 3:
+                return {'anchor': '4'}
+            return {'anchor': str(page + 1), 'feeds': [
+                {'pattern': 'POST', 'message': '{media_topic:%d}' % (100 - page * 2 - i),
+                 'owner_ref': 'group:%d' % group.id, 'author_ref': 'group:%d' % group.id,
+                 'date': '2014-04-11 12:53:%02d' % (50 - page * 2 - i)}
+                for i in range(2)]}
+
+        Discussion.remote.api_call = api_call
+        try:
+            self.assertRaises(OdnoklassnikiContentError, group.fetch_discussions, all=True, resumable=True)
+
+            # the first page is saved with checkpoint
+            checkpoint = CrawlCheckpoint.objects.get(group=group, method='stream')
+            self.assertEqual(checkpoint.anchor, '1')
+            self.assertEqual(checkpoint.date, Discussion.objects.order_by('date')[0].date)
+            self.assertEqual(Discussion.objects.count(), 2)
+
+            discussions = group.fetch_discussions(all=True, resumable=True)
+        finally:
+            del Discussion.remote.api_call
+
+        self.assertEqual(requests, [0, 1, 1, 2, 3])
+        self.assertEqual(discussions.count(), 4)
+        self.assertEqual(Discussion.objects.count(), 6)
+        self.assertEqual(CrawlCheckpoint.objects.get(group=group, method='stream').anchor, None)
+
+    def test_fetch_discussion_likes_diff(self):
+
+        discussion = DiscussionFactory(object_type='GROUP_TOPIC')
+        users = [UserFactory() for i in range(6)]
+        discussion.like_users = users[:3]
+        pages = []
+
+        def api_call(method='get', **kwargs):
+            page = int(kwargs.get('anchor', 0))
+            pages.append(page)
+            if page == len(users_pages):
+                return {'anchor': str(page)}
+            return {'anchor': str(page + 1), 'users': [{'uid': str(user.id), 'name': user.name}
+                                                       for user in users_pages[page]]}
+
+        Discussion.remote.api_call = api_call
+        try:
+            users_pages = [users[3:4], users[1:3]]
+            discussion.fetch_likes(all=True)
+            self.assertEqual(pages, [0, 1, 2])
+            self.assertItemsEqual(discussion.like_users.all(), users[1:4])
+            self.assertItemsEqual(discussion.like_users.removed_at(discussion.like_users.last_update_time()), users[:1])
+            self.assertEqual(discussion.like_users.through.objects.count(), 4)
+            self.assertEqual(discussion.likes_count, 3)
+
+            # the second page hasn't new users
+            pages = []
+            users_pages = [users[4:6], users[2:4], users[1:2]]
+            discussion.fetch_likes(all=True, incremental=True)
+            self.assertEqual(pages, [0, 1])
+            self.assertItemsEqual(discussion.like_users.all(), users[1:6])
+            self.assertEqual(discussion.like_users.through.objects.count(), 6)
+            self.assertEqual(discussion.likes_count, 5)
+
+            # default fetching of the first page only adds users and keeps counter
+            pages = []
+            users_pages = [users[:2], users[2:4]]
+            discussion.fetch_likes()
+            self.assertEqual(pages, [0])
+            self.assertItemsEqual(discussion.like_users.all(), users)
+            self.assertEqual(discussion.like_users.removed_at(discussion.like_users.last_update_time()).count(), 0)
+            self.assertEqual(Discussion.objects.get(pk=discussion.pk).likes_count, 5)
+        finally:
+            del Discussion.remote.api_call
+
+    def test_get_or_create_users(self):
+
+        user = UserFactory()
+        ids_new = [10 ** 9 + 1, 10 ** 9 + 2]
+        resources = [{'uid': str(id), 'name': 'New'} for id in ids_new + ids_new[1:]]
+        resources += [{'uid': str(user.id), 'name': 'Changed'}]
+
+        # select and insert in savepoint
+        with self.assertNumQueries(4):
+            ids = get_or_create_users(resources)
+
+        self.assertItemsEqual(ids, [user.id] + ids_new)
+        self.assertEqual(User.objects.count(), 3)
+        self.assertEqual(User.objects.get(pk=user.id).name, user.name)
+
+        # user inserted by another process after select is skipped
+        bulk_create_missing(User, [User(id=user.id, name='Concurrent'), User(id=10 ** 9 + 3, name='New')])
+        self.assertEqual(User.objects.count(), 4)
+        self.assertEqual(User.objects.get(pk=user.id).name, user.name)
+
+    def test_fetch_group_discussions_as_generator(self):
+
+        group = GroupFactory(id=GROUP4_ID)
+        requests = []
+
+        def api_call(method='get', **kwargs):
+            page = int(kwargs.get('anchor', 0))
+            requests.append(page)
+            if page == 2:
+                return {'anchor': '3'}
+            return {'anchor': str(page + 1), 'feeds': [
+                {'pattern': 'POST', 'message': '{media_topic:%d}' % (100 - page * 2 - i),
+                 'owner_ref': 'group:%d' % group.id, 'author_ref': 'group:%d' % group.id,
+                 'date': '2014-04-11 12:53:%02d' % (50 - page * 2 - i)}
+                for i in range(2)]}
+
+        Discussion.remote.api_call = api_call
+        try:
+            pages = group.fetch_discussions(all=True, as_generator=True)
+            self.assertEqual(requests, [])
+
+            discussions = next(pages)
+            self.assertEqual(requests, [0])
+            self.assertItemsEqual(discussions.values_list('pk', flat=True), [100, 99])
+
+            self.assertEqual([discussions.count() for discussions in pages], [2, 0])
+            self.assertEqual(requests, [0, 1, 2])
+        finally:
+            del Discussion.remote.api_call
+
+        self.assertEqual(Discussion.objects.count(), 4)
+
+    def test_fetch_discussion_comments_streaming(self):
+
+        discussion = DiscussionFactory(object_type='GROUP_TOPIC')
+        user = UserFactory()
+        saved = []
+
+        def api_call(method='get', **kwargs):
+            # pages from the newest comments: [c5, c4], [c3, c2], [c1, c0], c5 is reply to c0
+            page = int(kwargs.get('anchor', 0))
+            saved.append(Comment.objects.count())
+            comments = [{'id': 'c%d' % i, 'author_id': user.id, 'date': '2014-04-11 12:53:0%d' % i, 'text': 'text',
+                         'type': 'ACTIVE_MESSAGE'} for i in [5 - page * 2, 4 - page * 2]]
+            if page == 0:
+                comments[0].update(reply_to_comment_id='c0', reply_to_id=user.id)
+            return {'has_more': page < 2, 'anchor': str(page + 1), 'comments': comments}
+
+        Comment.remote.api_call = api_call
+        try:
+            comments = Comment.remote.fetch(discussion=discussion, all=True, streaming=True)
+        finally:
+            del Comment.remote.api_call
+
+        # each page is saved before requesting the next one
+        self.assertEqual(saved, [0, 2, 4])
+        self.assertEqual(comments.count(), 6)
+        self.assertEqual(Comment.objects.get(pk='c5').reply_to_comment, Comment.objects.get(pk='c0'))
+        self.assertEqual(Discussion.objects.get(pk=discussion.pk).comments_count, 6)
+
+    def test_refresh_many_discussions(self):
+
+        group = GroupFactory(id=GROUP4_ID)
+        discussions = [DiscussionFactory(owner=group, author=group, object_type='GROUP_TOPIC') for i in range(5)]
+        requests = []
+
+        def api_call(method='get', **kwargs):
+            ids = kwargs['topic_ids'].split(',')
+            requests.append(ids)
+            return {'media_topics': [{
+                'id': id, 'author_ref': 'group:%d' % group.id, 'owner_ref': 'group:%d' % group.id,
+                'created_ms': 1394010000000, 'media': [{'type': 'text', 'text': 'text'}],
+                'like_summary': {'count': int(id) % 2}, 'reshare_summary': {'count': 1},
+                'discussion_summary': {'comments_count': 3}} for id in ids if id != str(discussions[0].id)]}
+
+        Discussion.remote.api_call = api_call
+        try:
+            count = Discussion.remote.refresh_many(Discussion.objects.all(), chunk_size=2)
+        finally:
+            del Discussion.remote.api_call
+
+        self.assertEqual(count, 4)
+        self.assertItemsEqual(sum(requests, []), [str(discussion.id) for discussion in discussions])
+        self.assertEqual(max([len(ids) for ids in requests]), 2)
+        for discussion in Discussion.objects.exclude(pk=discussions[0].id):
+            self.assertEqual(discussion.likes_count, discussion.id % 2)
+            self.assertEqual(discussion.reshares_count, 1)
+            self.assertEqual(discussion.comments_count, 3)
+            self.assertNotEqual(discussion.fetched, None)
+        self.assertEqual(Discussion.objects.get(pk=discussions[0].id).fetched, None)
+
+    def test_refresh_scheduler(self):
+
+        scheduler = RefreshScheduler(age_part=0.25, interval_min=timedelta(minutes=10),
+                                     interval_max=timedelta(days=30), slot=timedelta(minutes=10))
+        now = datetime(2014, 4, 11, 12, 0, 3, tzinfo=timezone.utc)
+
+        self.assertEqual(scheduler.get_interval(now - timedelta(days=4), now=now), timedelta(days=1))
+        self.assertEqual(scheduler.get_interval(now - timedelta(days=4), changes=3, now=now), timedelta(hours=6))
+        self.assertEqual(scheduler.get_interval(now - timedelta(minutes=1), now=now), timedelta(minutes=10))
+        self.assertEqual(scheduler.get_interval(now - timedelta(days=1000), now=now), timedelta(days=30))
+        self.assertEqual(scheduler.get_refresh_at(now - timedelta(days=4), now=now),
+                         datetime(2014, 4, 12, 12, 10, tzinfo=timezone.utc))
+
+    def test_refresh_due_discussions(self):
+
+        now = timezone.now()
+        discussions = [DiscussionFactory(object_type='GROUP_TOPIC', date=now - timedelta(days=4),
+                                         last_activity_date=None) for i in range(3)]
+
+        # new discussions are scheduled by age
+        discussion = Discussion.objects.get(pk=discussions[0].pk)
+        self.assertGreater(discussion.refresh_at, now + timedelta(hours=23))
+        self.assertLess(discussion.refresh_at, now + timedelta(hours=25))
+        self.assertEqual(Discussion.remote.get_due().count(), 0)
+
+        Discussion.objects.filter(pk__in=[discussions[0].pk, discussions[1].pk]).update(refresh_at=now)
+        Discussion.objects.filter(pk=discussions[2].pk).update(refresh_at=None)
+        self.assertItemsEqual(Discussion.remote.get_due(), discussions)
+        self.assertEqual(Discussion.remote.get_due(limit=2).count(), 2)
+
+        # discussion with changed counters is refreshed sooner
+        instances = [Discussion(id=discussions[0].pk, likes_count=0), Discussion(id=discussions[1].pk, likes_count=3)]
+        self.assertEqual(Discussion.remote.update_counters(instances), 2)
+        refresh_at = dict(Discussion.objects.values_list('pk', 'refresh_at'))
+        self.assertGreater(refresh_at[discussions[0].pk], now + timedelta(hours=23))
+        self.assertLess(refresh_at[discussions[1].pk], now + timedelta(hours=7))
+        self.assertItemsEqual(Discussion.remote.get_due(), discussions[2:])
+
+    def test_crawl_groups_command(self):
+
+        groups = [GroupFactory(id=GROUP4_ID), GroupFactory(id=GROUP3_ID)]
+        user = UserFactory()
+
+        def discussions_api_call(method='get', **kwargs):
+            if method == 'get_likes':
+                return {'users': [{'uid': str(user.id), 'name': user.name}]}
+            if 'anchor' in kwargs:
+                return {'anchor': 'last'}
+            return {'anchor': 'first', 'feeds': [
+                {'pattern': 'POST', 'message': '{media_topic:%d%d}' % (kwargs['gid'], i),
+                 'owner_ref': 'group:%d' % kwargs['gid'], 'author_ref': 'group:%d' % kwargs['gid'],
+                 'date': '2014-04-11 12:53:0%d' % i} for i in range(2)]}
+
+        def comments_api_call(method='get', **kwargs):
+            if kwargs['discussionId'] == int('%d0' % GROUP3_ID):
+                raise OdnoklassnikiContentError()
+            return {'has_more': False, 'comments': [
+                {'id': '%s-%d' % (kwargs['discussionId'], i), 'author_id': user.id, 'text': 'text',
+                 'date': '2014-04-11 12:54:0%d' % i, 'type': 'ACTIVE_MESSAGE'} for i in range(3)]}
+
+        Discussion.remote.api_call = discussions_api_call
+        Comment.remote.api_call = comments_api_call
+        stdout = StringIO()
+        try:
+            call_command('crawl_odnoklassniki_groups', *[str(group.id) for group in groups], workers=2,
+                         after='2014-04-01', stdout=stdout)
+        finally:
+            del Discussion.remote.api_call
+            del Comment.remote.api_call
+
+        self.assertEqual(Discussion.objects.count(), 4)
+        self.assertEqual(Comment.objects.count(), 9)
+        self.assertEqual(Discussion.objects.filter(likes_count=1).count(), 4)
+
+        summary = dict([(line.split()[0], line.split()[1:3]) for line in stdout.getvalue().splitlines()])
+        self.assertEqual(summary['posts'], ['4', '0'])
+        self.assertEqual(summary['comments'], ['9', '1'])
+        self.assertEqual(summary['likes'], ['4', '0'])
+        self.assertIn('DB queries', stdout.getvalue())
+
+        self.assertRaises(CommandError, call_command, 'crawl_odnoklassniki_groups', str(GROUP4_ID), stages='votes')
+
+    def test_rate_limiter(self):
+
+        path = tempfile.mktemp()
+        try:
+            # buckets of different processes share the same file
+            buckets = [TokenBucket(rate=20, burst=2, path=path) for i in range(2)]
+            self.assertEqual(buckets[0].utilization(), 0)
+
+            self.assertEqual(buckets[0].acquire(), 0)
+            self.assertEqual(buckets[1].acquire(), 0)
+            self.assertAlmostEqual(buckets[0].utilization(), 1, places=1)
+
+            started = time.time()
+            self.assertGreater(buckets[1].acquire(), 0)
+            self.assertGreaterEqual(time.time() - started, 0.04)
+
+            time.sleep(0.1)
+            self.assertLess(buckets[0].utilization(), 0.1)
+        finally:
+            os.remove(path)
+
+    def test_response_cache(self):
+
+        path = tempfile.mkdtemp()
+        try:
+            cache = ResponseCache(path, ttls={'discussions.getComments': 0}, ttl=60, max_size=1000)
+            response = {'has_more': False, 'comments': [{'id': '1', 'text': u'текст'}]}
+
+            cache.set('stream.get', {'gid': 1, 'count': 10}, response)
+            # parameters are normalized by sorting
+            self.assertEqual(cache.get('stream.get', {'count': 10, 'gid': 1}), response)
+            self.assertEqual(cache.get('stream.get', {'count': 10, 'gid': 2}), None)
+
+            # responses of methods with zero TTL are not cached
+            cache.set('discussions.getComments', {'gid': 1}, response)
+            self.assertEqual(cache.get('discussions.getComments', {'gid': 1}), None)
+
+            # expired responses
+            filename = cache.get_filename('stream.get', {'gid': 1, 'count': 10})
+            os.utime(filename, (time.time() - 61, time.time() - 61))
+            self.assertEqual(cache.get('stream.get', {'gid': 1, 'count': 10}), None)
+
+            # the oldest responses are evicted
+            for i in range(100):
+                cache.set('stream.get', {'gid': i}, {'data': 'x' * 50 + str(i)})
+            self.assertLessEqual(sum([size for filename, mtime, size in cache.get_files()]), 1000)
+            self.assertEqual(cache.get('stream.get', {'gid': 0}), None)
+            self.assertEqual(cache.get('stream.get', {'gid': 99}), {'data': 'x' * 50 + '99'})
+
+            # replay of API calls by remote manager
+            calls = []
+
+            def api_call(method, **kwargs):
+                calls.append(method)
+                return {'has_more': False, 'comments': []}
+
+            api_call_original = api_models.api_call
+            models.response_cache = cache
+            api_models.api_call = api_call
+            try:
+                for i in range(2):
+                    response = Comment.remote.api_call('get', discussionId='1', discussionType='GROUP_TOPIC')
+                    self.assertEqual(response, {'has_more': False, 'comments': []})
+                    response = Discussion.remote.api_call('stream', gid=1)
+                    self.assertEqual(response, {'has_more': False, 'comments': []})
+            finally:
+                models.response_cache = None
+                api_models.api_call = api_call_original
+            self.assertEqual(calls, ['discussions.getComments', 'stream.get', 'discussions.getComments'])
+        finally:
+            shutil.rmtree(path)
+
+    def test_fake_api_record_and_replay(self):
+
+        group = GroupFactory(id=GROUP4_ID)
+        cassette = Cassette()
+        api = FakeApi(discussions=3, comments=5, likes=4, users=3)
+
+        with replace_api(cassette.record(api)):
+            discussions = Discussion.remote.fetch_group(group, all=True, count=2)
+            for discussion in discussions:
+                discussion.fetch_comments(all=True, count=2, bulk=True)
+                discussion.fetch_likes(all=True, count=3)
+
+        self.assertEqual(discussions.count(), 3)
+        self.assertEqual(Comment.objects.count(), 15)
+        self.assertEqual(Comment.objects.filter(reply_to_comment__isnull=False).count(), 3)
+        self.assertEqual(Discussion.objects.filter(likes_count=3).count(), 3)
+        self.assertEqual(len(cassette.interactions), api.calls)
+
+        path = tempfile.mktemp()
+        try:
+            cassette.save(path)
+            cassette = Cassette(path)
+        finally:
+            os.remove(path)
+
+        Comment.objects.all().delete()
+        with replace_api(cassette):
+            for discussion in Discussion.objects.all():
+                discussion.fetch_comments(all=True, count=2, bulk=True)
+            self.assertRaises(CassetteError, discussion.fetch_comments, all=True, count=10)
+        self.assertEqual(Comment.objects.count(), 15)
+
+    def test_api_metrics(self):
+
+        group = GroupFactory(id=GROUP4_ID)
+        discussion = DiscussionFactory(owner=group, author=group, object_type='GROUP_TOPIC')
+        metrics = ApiMetrics(log_interval=None)
+        pages = []
+
+        def receiver(sender, **kwargs):
+            pages.append(kwargs)
+
+        api_page_processed.connect(receiver)
+        models.api_metrics = metrics
+        try:
+            # queries aren't counted without debug cursor
+            with replace_api(FakeApi(comments=5, users=2)):
+                discussion.fetch_comments(all=True, count=2)
+            metrics.finish_page()
+            self.assertEqual([page['queries'] for page in pages], [None] * 3)
+            self.assertEqual(metrics.get_values()['discussions.getComments']['queries'], 0)
+            metrics.reset()
+            pages = []
+
+            with replace_api(FakeApi(comments=5, users=2)), capture_queries():
+                discussion.fetch_comments(all=True, count=2, bulk=True)
+                metrics.finish_page()
+        finally:
+            models.api_metrics = None
+            api_page_processed.disconnect(receiver)
+
+        values = metrics.get_values()
+        self.assertEqual(values.keys(), ['discussions.getComments'])
+        self.assertEqual(values['discussions.getComments']['calls'], 3)
+        self.assertEqual(values['discussions.getComments']['items'], 5)
+        self.assertGreater(values['discussions.getComments']['bytes'], 0)
+        self.assertGreater(values['discussions.getComments']['queries'], 0)
+
+        self.assertEqual(len(pages), 3)
+        self.assertEqual([page['items'] for page in pages if page['method'] == 'discussions.getComments'], [2, 2, 1])
+        self.assertIn('odnoklassniki_api_calls_total{method="discussions.getComments"} 3', metrics.text())
+
+    def test_comments_count_incremental_and_reconcile(self):
+
+        group = GroupFactory(id=GROUP4_ID)
+        # counters are totals from API
+        discussions = [DiscussionFactory(owner=group, author=group, object_type='GROUP_TOPIC', comments_count=5,
+                                         likes_count=10) for i in range(3)]
+
+        with replace_api(FakeApi(comments=5, likes=4, users=4)):
+            # one page keeps counter from API without COUNT query
+            with capture_queries() as queries:
+                discussions[0].fetch_comments(count=2)
+            self.assertEqual([query['sql'] for query in queries
+                              if 'COUNT(' in query['sql'] and 'odnoklassniki_discussions_comment' in query['sql']], [])
+            self.assertEqual(Discussion.objects.get(pk=discussions[0].pk).comments_count, 5)
+            discussions[0].fetch_comments(count=2)
+            self.assertEqual(Discussion.objects.get(pk=discussions[0].pk).comments_count, 5)
+
+            # all comments set counter to number of fetched comments
+            discussions[1].fetch_comments(all=True, count=2)
+            self.assertEqual(Discussion.objects.get(pk=discussions[1].pk).comments_count, 5)
+            discussions[1].fetch_likes(all=True)
+
+        # counters of discussions without stored rows are kept
+        Discussion.objects.filter(pk=discussions[1].pk).update(comments_count=1, likes_count=1)
+        with self.assertNumQueries(6):
+            self.assertEqual(Discussion.remote.reconcile_counters(Discussion.objects.all()), 2)
+        self.assertEqual(list(Discussion.objects.order_by('pk').values_list('comments_count', 'likes_count')),
+                         [(2, 10), (5, 4), (5, 10)])
+
+        stdout = StringIO()
+        call_command('reconcile_odnoklassniki_counters', str(GROUP4_ID), stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), 'Updated counters of 0 discussions')
+
+    def test_daily_engagement_rollups(self):
+
+        group = GroupFactory(id=GROUP1_ID)
+        fields = ('owner_id', 'date', 'object_type', 'discussions_count', 'comments_count', 'likes_count',
+                  'reshares_count')
+
+        def get_rollups():
+            return list(DailyEngagement.objects.order_by('date').values_list(*fields))
+
+        # rollups are disabled by default
+        with replace_api(FakeApi(discussions=3, comments=4, likes=3, users=5)):
+            Discussion.remote.fetch_group(group, all=True)
+        self.assertEqual(DailyEngagement.objects.count(), 0)
+        Discussion.objects.all().delete()
+
+        engagement_rollup.enabled = True
+        self.addCleanup(setattr, engagement_rollup, 'enabled', False)
+
+        with replace_api(FakeApi(discussions=30, comments=4, likes=3, users=5)):
+            discussions = list(Discussion.remote.fetch_group(group, all=True, count=10))
+            discussions[0].fetch_comments(all=True, count=2)
+            discussions[1].fetch_comments(all=True, count=2, bulk=True)
+            discussions[-1].fetch_comments(all=True)
+            # refetch doesn't change rollups
+            discussions[-1].fetch_comments(all=True)
+            list(Discussion.remote.fetch_group(group, all=True, count=10))
+
+        # discussions of fake API are published by hours back from FAKE_DATE, so they cover several days
+        rollups = get_rollups()
+        self.assertTrue(len(rollups) > 1)
+        self.assertEqual(sum([rollup[3] for rollup in rollups]), 30)
+        self.assertEqual(sum([rollup[4] for rollup in rollups]), 12)
+        self.assertEqual(sum([rollup[5] for rollup in rollups]), 90)
+
+        # incremental rollups are equal to rebuilt ones
+        DailyEngagement.objects.update(comments_count=0, likes_count=0)
+        self.assertEqual(engagement_rollup.rebuild(), len(rollups))
+        self.assertEqual(get_rollups(), rollups)
+
+        stdout = StringIO()
+        call_command('rebuild_odnoklassniki_rollups', str(GROUP4_ID), stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), 'Rebuilt 0 rows of daily engagement')
+        self.assertEqual(get_rollups(), rollups)
+
+    def test_keyset_pagination(self):
+
+        group = GroupFactory(id=GROUP1_ID)
+        date = timezone.now().replace(microsecond=0)
+        # pairs of discussions with equal dates
+        discussions = [DiscussionFactory(owner=group, date=date - timedelta(days=i / 2)) for i in range(7)]
+        DiscussionFactory(date=date)
+        comments = [CommentFactory(id='comment-%d' % i, discussion=discussions[0], date=date + timedelta(minutes=i % 3))
+                    for i in range(5)]
+        CommentFactory(discussion=discussions[1], date=date)
+
+        def get_pages(queryset, **kwargs):
+            pages, cursor = [], None
+            while True:
+                instances, cursor = queryset.page(cursor, size=2, **kwargs)
+                pages.append([instance.pk for instance in instances])
+                if cursor is None:
+                    return pages
+
+        ids = list(Discussion.objects.owned_by(group).order_by('-date', '-pk').values_list('pk', flat=True))
+        self.assertEqual(sum(get_pages(Discussion.objects.owned_by(group)), []), ids)
+        self.assertEqual(sum(get_pages(Discussion.objects.owned_by(group), reverse=False), []), ids[::-1])
+        self.assertEqual(map(len, get_pages(Discussion.objects.owned_by(group))), [2, 2, 2, 1])
+
+        ids = list(discussions[0].comments.order_by('date', 'pk').values_list('pk', flat=True))
+        self.assertEqual(len(ids), len(comments))
+        self.assertEqual(sum(get_pages(discussions[0].comments, reverse=False), []), ids)
+        self.assertEqual(sum(get_pages(Comment.objects.owned_by(group)), []),
+                         list(Comment.objects.order_by('-date', '-pk').values_list('pk', flat=True)))
+
+        # deep pages are selected by condition on date without OFFSET
+        instances, cursor = Discussion.objects.owned_by(group).page(size=5)
+        with capture_queries() as queries:
+            self.assertEqual(len(Discussion.objects.owned_by(group).page(cursor, size=5)[0]), 2)
+        self.assertNotIn('OFFSET', queries[0]['sql'])
+
+        with self.assertRaises(CursorError):
+            Discussion.objects.page('wrong')
+
+    def test_fetch_group_comments_concurrently(self):
+
+        group = GroupFactory(id=GROUP4_ID)
+        discussions = [DiscussionFactory(owner=group, object_type='GROUP_TOPIC') for i in range(4)]
+        user = UserFactory()
+
+        def api_call(method='get', **kwargs):
+            if kwargs['discussionId'] == discussions[0].id:
+                raise OdnoklassnikiContentError()
+            return {'has_more': False, 'comments': [
+                {'id': '%s-%d' % (kwargs['discussionId'], i), 'author_id': user.id, 'text': 'text',
+                 'date': '2014-04-11 12:53:0%d' % i, 'type': 'ACTIVE_MESSAGE'} for i in range(3)]}
+
+        Comment.remote.api_call = api_call
+        try:
+            counts, errors = Discussion.remote.fetch_group_comments(group, workers=2, queue_size=1)
+        finally:
+            del Comment.remote.api_call
+
+        self.assertEqual(errors.keys(), [discussions[0]])
+        self.assertEqual(counts, dict([(discussion, 3) for discussion in discussions[1:]]))
+        self.assertEqual(Comment.objects.count(), 9)
+        self.assertEqual(Comment.objects.filter(discussion=discussions[0]).count(), 0)
+        self.assertEqual(Discussion.objects.get(pk=discussions[1].pk).comments_count, 3)
+
+    def test_fetch_async(self):
+
+        group = GroupFactory(id=GROUP4_ID)
+        discussions = [DiscussionFactory(owner=group, object_type='GROUP_TOPIC') for i in range(3)]
+        user = UserFactory()
+
+        def comments_api_call(method='get', **kwargs):
+            return {'has_more': False, 'comments': [
+                {'id': '%s-%d' % (kwargs['discussionId'], i), 'author_id': user.id, 'text': 'text',
+                 'date': '2014-04-11 12:53:0%d' % i, 'type': 'ACTIVE_MESSAGE'} for i in range(2)]}
+
+        def likes_api_call(method='get', **kwargs):
+            if 'anchor' in kwargs:
+                return {'anchor': 'a2'}
+            return {'anchor': 'a1', 'users': [{'uid': str(user.id), 'name': user.name}]}
+
+        Comment.remote.api_call = comments_api_call
+        Discussion.remote.api_call = likes_api_call
+        try:
+            futures = [discussion.fetch_comments_async(all=True) for discussion in discussions]
+            futures += [discussions[0].fetch_likes_async()]
+            results = [future.result() for future in as_completed(futures)]
+        finally:
+            del Comment.remote.api_call
+            del Discussion.remote.api_call
+
+        self.assertEqual(len(results), 4)
+        self.assertEqual(Comment.objects.count(), 6)
+        self.assertEqual(Discussion.objects.get(pk=discussions[1].pk).comments_count, 2)
+        self.assertEqual(Discussion.objects.get(pk=discussions[0].pk).likes_count, 1)
+        self.assertEqual(list(discussions[0].like_users.all()), [user])
+
+    def test_fetch_async_error(self):
+
+        discussion = DiscussionFactory(object_type='GROUP_TOPIC')
+
+        def api_call(method='get', **kwargs):
+            raise OdnoklassnikiContentError()
+
+        Comment.remote.api_call = api_call
+        try:
+            future = discussion.fetch_comments_async()
+        finally:
+            del Comment.remote.api_call
+
+        self.assertRaises(OdnoklassnikiContentError, future.result)
+        self.assertEqual(Comment.objects.count(), 0)
+
+    def test_discussions_entities_batch_materialization(self):
+
+        group = GroupFactory(id=GROUP1_ID, name=u'Кока-Кола')
+        resources = []
+        for i in range(5):
+            resources += [{
+                'object_id': str(GROUP_DISCUSSION1_ID + i),
+                'object_type': 'GROUP_TOPIC',
+                'creation_date': '2013-10-12 14:29:26',
+                'owner_uid': str(163873406852 + i % 2),
+                'ref_objects': [{'id': str(GROUP1_ID), 'type': 'GROUP'}],
+                'entities': {
+                    'groups': [{'uid': str(GROUP1_ID), 'name': u'Кока-Кола'}],
+                    'users': [{'uid': str(163873406852 + i % 2), 'first_name': u'Любовь', 'last_name': u'Гуревич'}],
+                },
+            }]
+        instances = Discussion.remote.parse_response_list(resources)
+
+        with self.assertNumQueries(5):
+            # select users, select groups, insert users in savepoint
+            Discussion.remote.set_entities_instances(instances)
+
+        Discussion.remote.get_or_create_from_instances_list(instances)
+
+        self.assertEqual(Discussion.objects.count(), 5)
+        self.assertEqual(User.objects.count(), 2)
+        self.assertEqual(Group.objects.count(), 1)
+        self.assertEqual(Discussion.objects.get(pk=GROUP_DISCUSSION1_ID).owner, group)
+        self.assertEqual(Discussion.objects.get(pk=GROUP_DISCUSSION1_ID).author, User.objects.get(pk=163873406852))
+        self.assertEqual(Discussion.objects.get(pk=GROUP_DISCUSSION1_ID + 1).author, User.objects.get(pk=163873406853))
+
+        # saves of stored discussions, e.g. updates of counters, don't resolve entities again
+        discussion = Discussion.objects.get(pk=GROUP_DISCUSSION1_ID)
+        discussion.likes_count = 10
+        with self.assertNumQueries(1):
+            discussion.save()
+        self.assertEqual(Discussion.objects.get(pk=GROUP_DISCUSSION1_ID).owner, group)
+        self.assertEqual(Discussion.objects.get(pk=GROUP_DISCUSSION1_ID).author, User.objects.get(pk=163873406852))
+
+    def test_parse_refs_without_queries(self):
+
+        ref_resolver.resolve('user:1')
+
+        with self.assertNumQueries(0):
+            instance = Discussion()
+            instance.parse({'id': str(GROUP_DISCUSSION1_ID), 'author_ref': 'user:163873406852',
+                            'owner_ref': 'group:%s' % GROUP1_ID, 'created_ms': 1381580966000})
+
+            comment = Comment()
+            comment.parse({'id': 'c1', 'author_id': str(GROUP1_ID), 'author_type': 'GROUP', 'author_name': 'name',
+                           'reply_to_comment_id': 'c0', 'reply_to_id': '163873406852', 'type': 'ACTIVE_MESSAGE'})
+
+        self.assertEqual(instance.author_content_type, ContentType.objects.get_for_model(User))
+        self.assertEqual(instance.author_id, 163873406852)
+        self.assertEqual(instance.owner_content_type, ContentType.objects.get_for_model(Group))
+        self.assertEqual(instance.owner_id, GROUP1_ID)
+        self.assertEqual(comment.author_content_type, ContentType.objects.get_for_model(Group))
+        self.assertEqual(comment.reply_to_author_content_type, ContentType.objects.get_for_model(User))
+        self.assertEqual(comment.reply_to_comment_remote_id, 'c0')
+
+    def test_discussion_normalizer(self):
+
+        # stream.get
+        response = {'message': u'{media_topic:62465446084728}Текст', 'author_ref': 'group:53038939046008',
+                    'owner_ref': 'group:53038939046008', 'like_summary': {'count': 36}}
+        refs = discussion_normalizer.normalize(response)
+
+        self.assertEqual(refs, {'author': 'group', 'owner': 'group'})
+        self.assertEqual(response, {'id': '62465446084728', 'message': u'Текст', 'author_id': '53038939046008',
+                                    'owner_id': '53038939046008', 'likes_count': 36})
+
+        # mediatopic.getByIds
+        response = {'id': '62465446084728', 'author_ref': 'user:1', 'owner_ref': 'group:2', 'created_ms': 1394010000000,
+                    'media': [{'type': 'text', 'text': u'Текст'}], 'reshare_summary': {'count': 1},
+                    'discussion_summary': {'comments_count': 3}}
+        refs = discussion_normalizer.normalize(response)
+
+        self.assertEqual(refs, {'author': 'user', 'owner': 'group'})
+        self.assertEqual(response['date'], 1394010000)
+        self.assertEqual(response['title'], u'Текст')
+        self.assertEqual(response['reshares_count'], 1)
+        self.assertEqual(response['comments_count'], 3)
+
+        # discussions.get with poll
+        response = {'discussion': {'object_id': '1', 'owner_uid': '2', 'total_comments_count': 5},
+                    'entities': {'media_topics': [{'media': [{'text': u'Опрос'}]}],
+                                 'polls': [{'vote_summary': {'count': 115, 'last_vote_date_ms': 1444481497205}}]}}
+        refs = discussion_normalizer.normalize(response)
+
+        self.assertEqual(refs, {})
+        self.assertEqual(response['author_id'], '2')
+        self.assertEqual(response['comments_count'], 5)
+        self.assertEqual(response['title'], u'Опрос')
+        self.assertEqual(response['votes_count'], 115)
+        self.assertEqual(response['last_vote_date'], 1444481497)